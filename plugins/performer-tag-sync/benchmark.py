@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+"""
+Performer Tag Sync benchmark
+Builds a synthetic database shaped like the Stash schema (v72) and times the sync functions
+against it in ADD and SET modes, per engine and batch size. Each scenario runs in a fresh
+process on its own copy of the database and reports items/sec, peak RSS and WAL growth.
+Runs fully offline - no Stash server or stashapi needed.
+
+Usage: python benchmark.py [--images N] [--batch-sizes 1000,5000] [--json results.json] [--keep DIR]
+"""
+
+import argparse
+import importlib.util
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows - peak RSS is reported as unknown
+    resource = None
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SCHEMA_SQL = """
+CREATE TABLE schema_migrations (version uint64 NOT NULL, dirty bool NOT NULL);
+CREATE TABLE tags (id INTEGER PRIMARY KEY AUTOINCREMENT, name VARCHAR(255) NOT NULL);
+CREATE UNIQUE INDEX index_tags_on_name ON tags (name COLLATE NOCASE);
+CREATE TABLE tags_relations (
+    parent_id integer NOT NULL, child_id integer NOT NULL,
+    PRIMARY KEY (parent_id, child_id));
+CREATE INDEX index_tags_relations_on_child_id ON tags_relations (child_id);
+CREATE TABLE performers (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, name VARCHAR(255) NOT NULL,
+    created_at DATETIME NOT NULL, updated_at DATETIME NOT NULL);
+CREATE TABLE performers_tags (
+    performer_id integer NOT NULL, tag_id integer NOT NULL,
+    PRIMARY KEY (performer_id, tag_id));
+CREATE INDEX index_performers_tags_on_tag_id ON performers_tags (tag_id);
+CREATE TABLE galleries_images (
+    gallery_id integer NOT NULL, image_id integer NOT NULL,
+    PRIMARY KEY (gallery_id, image_id));
+CREATE INDEX index_galleries_images_on_image_id ON galleries_images (image_id);
+"""
+
+ENTITY_SCHEMA_SQL = """
+CREATE TABLE {table} (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, title VARCHAR(255),
+    organized BOOLEAN NOT NULL DEFAULT '0',
+    created_at DATETIME NOT NULL, updated_at DATETIME NOT NULL);
+CREATE TABLE {tags_table} (
+    {id_column} integer NOT NULL, tag_id integer NOT NULL,
+    PRIMARY KEY ({id_column}, tag_id));
+CREATE INDEX index_{tags_table}_on_tag_id ON {tags_table} (tag_id);
+CREATE TABLE {performers_table} (
+    performer_id integer NOT NULL, {id_column} integer NOT NULL,
+    PRIMARY KEY ({id_column}, performer_id));
+CREATE INDEX index_{performers_table}_on_performer_id ON {performers_table} (performer_id);
+"""
+
+
+def load_plugin():
+    """Import performer_tag_sync.py and silence its logging"""
+    spec = importlib.util.spec_from_file_location(
+        "performer_tag_sync", os.path.join(PLUGIN_DIR, "performer_tag_sync.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    class QuietLog:
+        @staticmethod
+        def info(msg): pass
+        @staticmethod
+        def warning(msg): pass
+        @staticmethod
+        def error(msg): print(f"ERROR: {msg}", file=sys.stderr)
+        @staticmethod
+        def debug(msg): pass
+        @staticmethod
+        def progress(p): pass
+
+    module.log = QuietLog
+    return module
+
+
+def create_synthetic_db(path, plugin, images, galleries, scenes, performers, tags,
+                        tags_per_performer=5, performers_per_item=2, organized_ratio=0.0,
+                        manual_tags_per_item=0, parent_tags_ratio=0.0, gallery_images_ratio=0.0, seed=1):
+    """Generate a database with the tables the plugin reads and writes
+
+    organized_ratio marks that share of items as organized, and manual_tags_per_item gives
+    every item that many random tags of its own, so SET mode has something to remove.
+    parent_tags_ratio gives that share of tags a parent among the 50 tags before it, and
+    every tenth of those a second one, which builds deep chains. gallery_images_ratio puts
+    that share of images in a random gallery.
+    """
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA_SQL)
+    for entity in plugin.ENTITIES.values():
+        conn.executescript(ENTITY_SCHEMA_SQL.format(**entity))
+
+    now = "2025-01-01 00:00:00"
+    conn.execute("INSERT INTO schema_migrations VALUES (72, 0)")
+    conn.executemany("INSERT INTO tags (id, name) VALUES (?, ?)",
+                     ((t, f"tag {t}") for t in range(1, tags + 1)))
+    conn.executemany("INSERT INTO performers (id, name, created_at, updated_at) VALUES (?, ?, ?, ?)",
+                     ((p, f"performer {p}", now, now) for p in range(1, performers + 1)))
+    conn.executemany("INSERT INTO performers_tags VALUES (?, ?)", (
+        (p, t) for p in range(1, performers + 1)
+        for t in rng.sample(range(1, tags + 1), min(tags_per_performer, tags))))
+
+    counts = {"images": images, "galleries": galleries, "scenes": scenes}
+    for key, entity in plugin.ENTITIES.items():
+        count = counts[key]
+        conn.executemany(
+            f"INSERT INTO {entity['table']} (id, organized, created_at, updated_at) VALUES (?, ?, ?, ?)",
+            ((i, int(bool(organized_ratio) and rng.random() < organized_ratio), now, now) for i in range(1, count + 1)))
+        conn.executemany(f"INSERT OR IGNORE INTO {entity['performers_table']} VALUES (?, ?)", (
+            (p, i) for i in range(1, count + 1)
+            for p in rng.sample(range(1, performers + 1), min(performers_per_item, performers))))
+        if manual_tags_per_item:
+            conn.executemany(f"INSERT OR IGNORE INTO {entity['tags_table']} VALUES (?, ?)", (
+                (i, t) for i in range(1, count + 1)
+                for t in rng.sample(range(1, tags + 1), min(manual_tags_per_item, tags))))
+
+    if parent_tags_ratio:
+        # A separate generator, so the rest of the database doesn't depend on the hierarchy
+        tag_rng = random.Random(seed + 1)
+        relations = set()
+        for t in range(2, tags + 1):
+            if tag_rng.random() < parent_tags_ratio:
+                relations.add((max(1, t - tag_rng.randint(1, 50)), t))
+                if tag_rng.random() < 0.1:
+                    relations.add((tag_rng.randint(1, t - 1), t))
+        conn.executemany("INSERT OR IGNORE INTO tags_relations VALUES (?, ?)", sorted(relations))
+
+    if gallery_images_ratio and galleries:
+        gallery_rng = random.Random(seed + 2)
+        conn.executemany("INSERT OR IGNORE INTO galleries_images VALUES (?, ?)", (
+            (gallery_rng.randint(1, galleries), i) for i in range(1, images + 1)
+            if gallery_rng.random() < gallery_images_ratio))
+
+    conn.commit()
+    conn.close()
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, or None where unsupported"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KB on Linux but bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def time_sync(plugin, db_path, settings):
+    """Run every sync function against db_path and return per-entity timings"""
+    plugin.ensure_tag_closure(db_path, settings)
+    snapshot = None
+    if settings["snapshotReads"]:
+        snapshot = plugin.ReadSnapshot(db_path, settings, list(plugin.ENTITIES))
+    try:
+        if settings["pipeline"]:
+            # All types at once - each type's seconds run from its start to its last write
+            results = plugin.sync_pipelined(db_path, settings, None, list(plugin.ENTITIES), snapshot)
+            return {key: dict(stats, items_per_sec=round(stats["items"] / stats["seconds"]) if stats["seconds"] else 0)
+                    for key, stats in results.items()}
+
+        results = {}
+        for key in plugin.ENTITIES:
+            start = time.perf_counter()
+            stats = plugin.sync_entity(db_path, settings, None, key, snapshot)
+            elapsed = time.perf_counter() - start
+            results[key] = dict(stats, seconds=round(elapsed, 3),
+                                items_per_sec=round(stats["items"] / elapsed) if elapsed else 0)
+        return results
+    finally:
+        if snapshot:
+            snapshot.close()
+
+
+def run_scenario(base_db, workdir, scenario, results):
+    """Child process: time one (mode, engine, batch size) scenario on a fresh copy of the database"""
+    plugin = load_plugin()
+    name = "-".join(str(value) for value in scenario.values()).lower()
+    db_path = os.path.join(workdir, f"{name}.sqlite")
+    shutil.copyfile(base_db, db_path)
+    plugin.enable_wal_mode(db_path)
+    settings = dict(plugin.DEFAULT_SETTINGS, **scenario)
+
+    # Hold a connection open so the WAL isn't checkpointed away when the sync closes its own
+    holder = sqlite3.connect(db_path)
+    holder.execute("SELECT 1 FROM schema_migrations").fetchall()
+
+    plugin.metrics.reset()
+    start = time.perf_counter()
+    first = time_sync(plugin, db_path, settings)
+    first_seconds = time.perf_counter() - start
+    first_metrics = plugin.metrics.summary()
+    wal_bytes = os.path.getsize(f"{db_path}-wal") if os.path.exists(f"{db_path}-wal") else 0
+    start = time.perf_counter()
+    rerun = time_sync(plugin, db_path, settings)
+    rerun_seconds = time.perf_counter() - start
+
+    holder.close()
+    os.remove(db_path)
+    results.put(dict(scenario, first_run=first, rerun=rerun, first_run_metrics=first_metrics,
+                     first_run_seconds=round(first_seconds, 3), rerun_seconds=round(rerun_seconds, 3),
+                     wal_mb=round(wal_bytes / (1024 * 1024), 1), peak_rss_mb=peak_rss_mb()))
+
+
+def run_extras(base_db, workdir, batch_size, images, results):
+    """Child process: delta sync on an idle library, single-item hook latency and performer fan-out"""
+    plugin = load_plugin()
+    db_path = os.path.join(workdir, "extras.sqlite")
+    shutil.copyfile(base_db, db_path)
+    plugin.enable_wal_mode(db_path)
+    settings = dict(plugin.DEFAULT_SETTINGS, deltaSync=True, batchSize=batch_size)
+
+    # Delta sync: the first run records the watermark, the second one sees an idle library
+    time_sync(plugin, db_path, settings)
+    start = time.perf_counter()
+    time_sync(plugin, db_path, settings)
+    idle = time.perf_counter() - start
+
+    # Hook path: one item at a time, as Image.Update.Post would trigger it
+    samples = random.Random(2).sample(range(1, images + 1), min(200, images))
+    start = time.perf_counter()
+    for image_id in samples:
+        plugin.sync_item(db_path, settings, None, "images", image_id)
+    per_item = (time.perf_counter() - start) / max(len(samples), 1)
+
+    # Performer fan-out: swap one tag of the performer with the most items, as
+    # Performer.Update.Post would trigger it
+    conn = sqlite3.connect(db_path)
+    perf_id, performer_items = conn.execute("""
+        SELECT performer_id, COUNT(*) FROM (
+            SELECT performer_id FROM performers_images UNION ALL
+            SELECT performer_id FROM performers_galleries UNION ALL
+            SELECT performer_id FROM performers_scenes)
+        GROUP BY performer_id ORDER BY COUNT(*) DESC LIMIT 1
+    """).fetchone()
+    conn.execute("""
+        UPDATE performers_tags SET tag_id = (SELECT MAX(id) + 1 FROM tags)
+        WHERE performer_id = ? AND tag_id = (SELECT MIN(tag_id) FROM performers_tags WHERE performer_id = ?)
+    """, (perf_id, perf_id))
+    conn.commit()
+    conn.close()
+    start = time.perf_counter()
+    plugin.sync_performers(db_path, settings, None, [perf_id])
+    fanout = time.perf_counter() - start
+
+    os.remove(db_path)
+    results.put({"delta_idle_seconds": round(idle, 3), "hook_item_ms": round(per_item * 1000, 2),
+                 "performer_fanout_ms": round(fanout * 1000, 2), "performer_fanout_items": performer_items})
+
+
+def time_cold_start(plugin, base_db, workdir, runs=10):
+    """Time whole plugin processes handling an image hook, as Stash starts one per event
+
+    A config.yml and a primed configuration cache stand in for an earlier run, so this is
+    a cached start: interpreter, imports, input, settings and one hook sync. Returns the
+    median milliseconds, along with a bare interpreter start for reference.
+    """
+    db_path = os.path.join(workdir, "cold-start.sqlite")
+    shutil.copyfile(base_db, db_path)
+    plugin.enable_wal_mode(db_path)
+    config_dir = os.path.join(workdir, "config")
+    os.makedirs(config_dir, exist_ok=True)
+    config_file = os.path.join(config_dir, "config.yml")
+    with open(config_file, "w") as f:
+        f.write(f"database: {db_path}\n")
+    stat = os.stat(config_file)
+    plugin.write_config_cache(config_file, [stat.st_mtime_ns, stat.st_size], db_path, {})
+
+    def median_ms(command, stdin=""):
+        samples = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run(command, input=stdin, text=True, check=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            samples.append(time.perf_counter() - start)
+        return round(statistics.median(samples) * 1000, 2)
+
+    plugin_input = json.dumps({
+        "server_connection": {"Dir": config_dir},
+        "args": {"hookContext": {"type": "Image.Update.Post", "id": 1, "inputFields": ["performer_ids"]}},
+    })
+    report = {"hook_ms": median_ms([sys.executable, os.path.join(PLUGIN_DIR, "performer-tag-sync.py")], plugin_input),
+              "interpreter_ms": median_ms([sys.executable, "-c", "pass"])}
+    shutil.rmtree(config_dir, ignore_errors=True)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    return report
+
+
+def run_map_benchmark(base_db, results):
+    """Child process: memory and build time of the dict and compact performer -> tags maps"""
+    plugin = load_plugin()
+    conn = sqlite3.connect(base_db)
+    pairs = plugin.load_performer_tag_pairs(conn.cursor())
+    conn.close()
+
+    report = {"pairs": len(pairs) // 2, "numpy": plugin.import_numpy() is not None}
+
+    conn = sqlite3.connect(base_db)
+    start = time.perf_counter()
+    closure = plugin.build_tag_closure(conn.cursor())
+    report["tag_closure"] = {"tags": len(closure), "pairs": sum(map(len, closure.values())),
+                             "build_seconds": round(time.perf_counter() - start, 3)}
+    conn.close()
+    del closure
+
+    for name, build in (("dict", plugin.performer_tags_from_pairs), ("compact", plugin.PerformerTagMap)):
+        tracemalloc.start()
+        start = time.perf_counter()
+        performer_tags = build(pairs)
+        elapsed = time.perf_counter() - start
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        report[name] = {"mb": round(size / (1024 * 1024), 2), "build_seconds": round(elapsed, 3),
+                        "performers": len(performer_tags)}
+        del performer_tags
+    results.put(report)
+
+
+def run_in_child(target, *args):
+    """Run target in a freshly spawned process so peak RSS covers only that work"""
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=target, args=args + (results,))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def print_scenario(result):
+    first = result["first_run"]
+    rerun = result["rerun"]
+    cells = "  ".join(
+        f"{key} {first[key]['items_per_sec']:>8}/s {rerun[key]['items_per_sec']:>8}/s" for key in first)
+    print(f"{result['tagMode']:<4} {result['engine']:<6} {'compact' if result['compactMaps'] else 'dict':<7} "
+          f"{'yes' if result['pipeline'] else 'no':<8} {'yes' if result['includeParentTags'] else 'no':<7} "
+          f"{'yes' if result['inheritGalleryPerformers'] else 'no':<9} "
+          f"{'yes' if result['snapshotReads'] else 'no':<8} "
+          f"{result['batchSize']:>6}  {result['first_run_seconds']:8.2f}s {result['rerun_seconds']:8.2f}s  "
+          f"{result['peak_rss_mb']!s:>6} MB  "
+          f"{result['wal_mb']:>7} MB   {cells}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=200000)
+    parser.add_argument("--galleries", type=int, default=5000)
+    parser.add_argument("--scenes", type=int, default=40000)
+    parser.add_argument("--performers", type=int, default=5000)
+    parser.add_argument("--tags", type=int, default=2000)
+    parser.add_argument("--tags-per-performer", type=int, default=5)
+    parser.add_argument("--performers-per-item", type=int, default=2)
+    parser.add_argument("--organized-ratio", type=float, default=0.0)
+    parser.add_argument("--manual-tags-per-item", type=int, default=1)
+    parser.add_argument("--parent-tags-ratio", type=float, default=0.5)
+    parser.add_argument("--gallery-images-ratio", type=float, default=0.5)
+    parser.add_argument("--modes", default="ADD,SET", help="Comma-separated tag modes to run")
+    parser.add_argument("--engines", default="SQL,PYTHON", help="Comma-separated ADD mode engines to run")
+    parser.add_argument("--batch-sizes", default="5000", help="Comma-separated batch sizes to run")
+    parser.add_argument("--pipeline", action="store_true", help="Also run every scenario with the pipelined sync")
+    parser.add_argument("--compact", action="store_true",
+                        help="Also run every Python engine scenario with compact performer tag maps")
+    parser.add_argument("--parent-tags", action="store_true", help="Also run every scenario applying parent tags")
+    parser.add_argument("--gallery-performers", action="store_true",
+                        help="Also run every scenario with images inheriting their galleries' performers")
+    parser.add_argument("--snapshot", action="store_true",
+                        help="Also run every scenario reading from an in-memory snapshot")
+    parser.add_argument("--json", help="Write the results to this file as JSON")
+    parser.add_argument("--keep", help="Directory to keep the generated database in")
+    args = parser.parse_args()
+
+    plugin = load_plugin()
+    workdir = args.keep or tempfile.mkdtemp(prefix="pts-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    base_db = os.path.join(workdir, "base.sqlite")
+
+    scenarios = []
+    for mode in args.modes.upper().split(","):
+        # SET mode always runs on the Python engine
+        engines = args.engines.upper().split(",") if mode == "ADD" else ["PYTHON"]
+        for engine in engines:
+            for batch_size in args.batch_sizes.split(","):
+                for pipeline in ([False, True] if args.pipeline else [False]):
+                    for compact in ([False, True] if args.compact and engine == "PYTHON" else [False]):
+                        for parents in ([False, True] if args.parent_tags else [False]):
+                            for inherit in ([False, True] if args.gallery_performers else [False]):
+                                for snapshot in ([False, True] if args.snapshot else [False]):
+                                    scenarios.append({"tagMode": mode, "engine": engine,
+                                                      "batchSize": int(batch_size), "pipeline": pipeline,
+                                                      "compactMaps": compact, "includeParentTags": parents,
+                                                      "inheritGalleryPerformers": inherit,
+                                                      "snapshotReads": snapshot})
+
+    try:
+        print(f"Generating synthetic database in {workdir}...")
+        if os.path.exists(base_db):
+            os.remove(base_db)
+        start = time.perf_counter()
+        create_synthetic_db(base_db, plugin, args.images, args.galleries, args.scenes,
+                            args.performers, args.tags, args.tags_per_performer,
+                            args.performers_per_item, args.organized_ratio, args.manual_tags_per_item,
+                            args.parent_tags_ratio, args.gallery_images_ratio)
+        print(f"Generated in {time.perf_counter() - start:.1f}s "
+              f"({os.path.getsize(base_db) / (1024 * 1024):.0f} MB)\n")
+
+        print("Mode Engine Maps    Pipeline Parents Galleries Snapshot  Batch  First run   Re-run   Peak RSS  WAL growth   items/sec (first, re-run)")
+        results = []
+        for scenario in scenarios:
+            result = run_in_child(run_scenario, base_db, workdir, scenario)
+            print_scenario(result)
+            results.append(result)
+
+        extras = run_in_child(run_extras, base_db, workdir, int(args.batch_sizes.split(",")[0]), args.images)
+        print(f"\nDelta sync on an idle library {extras['delta_idle_seconds']:8.2f}s")
+        print(f"Hook sync of a single image     {extras['hook_item_ms']:8.2f}ms")
+        print(f"Performer fan-out ({extras['performer_fanout_items']} items) {extras['performer_fanout_ms']:8.2f}ms")
+        cold = time_cold_start(plugin, base_db, workdir)
+        print(f"Cold start of a hook process    {cold['hook_ms']:8.2f}ms "
+              f"(interpreter alone {cold['interpreter_ms']:.2f}ms)")
+        extras["cold_start"] = cold
+
+        maps = run_in_child(run_map_benchmark, base_db)
+        print(f"\nPerformer tag map ({maps['pairs']} pairs, NumPy {'yes' if maps['numpy'] else 'no'}):")
+        for name in ("dict", "compact"):
+            print(f"  {name:<8} {maps[name]['mb']:8.2f} MB  built in {maps[name]['build_seconds']:.3f}s")
+        closure = maps["tag_closure"]
+        print(f"Tag hierarchy closure ({closure['tags']} tags with parents, {closure['pairs']} ancestor pairs) "
+              f"built in {closure['build_seconds']:.3f}s")
+        extras["performer_tag_maps"] = maps
+
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({"parameters": vars(args), "scenarios": results, "extras": extras}, f, indent=2)
+            print(f"\nResults written to {args.json}")
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,3246 @@
+"""
+Performer Tag Sync
+Efficiently syncs performer tags to images, galleries, and scenes using direct SQLite access.
+High-performance implementation optimized for large libraries.
+
+Stash runs performer-tag-sync.py, which only imports this module and calls main(), so
+each run loads this code's cached bytecode instead of compiling it. Modules only the
+bulk tasks need (gzip, zlib, queue, threading, random, re) are imported where they are
+used, keeping them off a hook's start.
+"""
+
+import _thread
+import sqlite3
+import sys
+import json
+import os
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import chain
+from contextlib import contextmanager
+from functools import partial
+
+# Try to import stashapi for logging, fallback to basic logging. StashInterface is
+# imported only when the Stash configuration has to be fetched - see get_stash_configuration
+try:
+    import stashapi.log as log
+    USE_STASH_LOG = True
+except ImportError:
+    USE_STASH_LOG = False
+    class log:
+        @staticmethod
+        def info(msg): print(f"INFO: {msg}", file=sys.stderr)
+        @staticmethod
+        def warning(msg): print(f"WARNING: {msg}", file=sys.stderr)
+        @staticmethod
+        def error(msg): print(f"ERROR: {msg}", file=sys.stderr)
+        @staticmethod
+        def debug(msg): print(f"DEBUG: {msg}", file=sys.stderr)
+        @staticmethod
+        def progress(p): pass
+
+# NumPy is optional - with it, compact maps diff whole batches as arrays. Only compact
+# maps use it, so it is imported on first use by import_numpy
+np = None
+_numpy_checked = False
+
+# Schema version compatibility
+# This plugin is tested with Stash schema version 72
+SUPPORTED_SCHEMA_VERSIONS = [72]
+SCHEMA_WARNING_ONLY = True  # Set to False to refuse running on unsupported versions
+
+# Plugin settings with defaults
+DEFAULT_SETTINGS = {
+    "enableImages": True,
+    "enableGalleries": True,
+    "enableScenes": True,
+    "tagMode": "ADD",
+    "engine": "SQL",  # SQL = set-based INSERT ... SELECT for ADD mode, PYTHON = per-item diff
+    "batchSize": 5000,  # Much larger batches possible with SQL
+    "excludeOrganized": False,
+    "excludeTag": "",  # Comma-separated names of tags whose items are skipped
+    "excludeChildTags": False,  # Also skip items tagged with a child (or grandchild, ...) of an exclusion tag
+    "deltaSync": False,  # Only reprocess items whose performers or performer tags changed since the last run
+    "coalesceHooks": True,  # Queue hook events and let a single process drain them in batches
+    "writeBudgetMs": 200,  # Target time each write transaction holds the database lock (0 = one transaction per batch)
+    "resumeSync": True,  # Continue an interrupted bulk sync after its last committed item instead of starting over
+    "pipeline": False,  # Read and diff each entity type on its own thread while a single writer thread writes
+    "compactMaps": False,  # Hold the performer -> tags map as sorted integer arrays instead of a dict of sets
+    "snapshotReads": False,  # Copy the tables a bulk sync reads into memory first and compute every diff against that copy
+    "journalChanges": False,  # Record every tag row a task adds or removes so Roll Back Last Sync can undo it
+    "trackProvenance": False,  # Record which tag rows the plugin added and through which performer
+    "includeParentTags": False,  # Also apply every ancestor (parent, grandparent, ...) of each performer tag
+    "inheritGalleryPerformers": False,  # Treat the performers of an image's galleries as performers of the image
+    "metricsTextfile": ""  # Prometheus textfile collector path to write run metrics to (empty = off)
+}
+
+# Settings that change which tags a run would write - a delta watermark is only
+# valid while these stay the same
+DELTA_SETTINGS_KEYS = ["tagMode", "excludeOrganized", "excludeTag", "excludeChildTags", "includeParentTags",
+                       "inheritGalleryPerformers"]
+
+# Settings that change which items a run visits and in what order - a resume
+# checkpoint (stored per tag mode) is only valid while these stay the same
+CHECKPOINT_SETTINGS_KEYS = ["engine", "excludeOrganized", "excludeTag", "excludeChildTags", "deltaSync",
+                            "includeParentTags", "inheritGalleryPerformers"]
+
+# Table layout for each entity type the plugin can tag
+ENTITIES = {
+    "images": {
+        "label": "images",
+        "singular": "image",
+        "table": "images",
+        "alias": "i",
+        "id_column": "image_id",
+        "tags_table": "images_tags",
+        "performers_table": "performers_images",
+    },
+    "galleries": {
+        "label": "galleries",
+        "singular": "gallery",
+        "table": "galleries",
+        "alias": "g",
+        "id_column": "gallery_id",
+        "tags_table": "galleries_tags",
+        "performers_table": "performers_galleries",
+    },
+    "scenes": {
+        "label": "scenes",
+        "singular": "scene",
+        "table": "scenes",
+        "alias": "s",
+        "id_column": "scene_id",
+        "tags_table": "scenes_tags",
+        "performers_table": "performers_scenes",
+    },
+}
+
+# Plugin-owned queue of items waiting to be synced by a hook drainer. seq is
+# AUTOINCREMENT so a re-queued item never reuses a seq an active drain has read
+QUEUE_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS pts_queue (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        entity TEXT NOT NULL,
+        item_id INTEGER NOT NULL,
+        UNIQUE (entity, item_id)
+    )
+"""
+
+# Single-row lease held by the process currently draining the queue
+DRAINER_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS pts_drainer (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        owner TEXT NOT NULL,
+        expires REAL NOT NULL
+    )
+"""
+DRAIN_LEASE_SECONDS = 60
+
+# Plugin-owned ledger of the (item, tag) rows this plugin added and the performers
+# that implied them, so stale derived tags can be retracted without touching manual ones
+PROVENANCE_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS pts_provenance (
+        entity TEXT NOT NULL,
+        item_id INTEGER NOT NULL,
+        tag_id INTEGER NOT NULL,
+        performer_id INTEGER NOT NULL,
+        PRIMARY KEY (entity, item_id, tag_id, performer_id)
+    ) WITHOUT ROWID
+"""
+
+# Plugin-owned transitive closure of tags_relations: a row (tag, ancestor) for every
+# ancestor of every tag that has a parent, plus (tag, tag) for those tags. Tags without
+# parents have no rows, which is why PARENT_TAGS_SQL falls back to the tag itself
+TAG_CLOSURE_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS pts_tag_closure (
+        tag_id INTEGER NOT NULL,
+        ancestor_id INTEGER NOT NULL,
+        PRIMARY KEY (tag_id, ancestor_id)
+    ) WITHOUT ROWID
+"""
+
+# Drop-in replacement for performers_tags with every performer tag expanded to itself
+# and its ancestors. A plain join, so SQLite flattens it into the queries using it
+PARENT_TAGS_SQL = """(
+    SELECT pt.performer_id AS performer_id, COALESCE(c.ancestor_id, pt.tag_id) AS tag_id
+    FROM performers_tags pt
+    LEFT JOIN pts_tag_closure c ON c.tag_id = pt.tag_id
+)"""
+
+# Drop-in replacement for performers_images that also links every image to the
+# performers of the galleries it is in. A UNION ALL of plain joins, so SQLite pushes an
+# image or performer constraint down into both halves
+GALLERY_IMAGE_PERFORMERS_SQL = """(
+    SELECT image_id, performer_id FROM performers_images
+    UNION ALL
+    SELECT gi.image_id, pg.performer_id
+    FROM galleries_images gi
+    INNER JOIN performers_galleries pg ON pg.gallery_id = gi.gallery_id
+)"""
+
+# Images with a performer of their own or of one of their galleries, walked in ID order.
+# Paging through DISTINCT over GALLERY_IMAGE_PERFORMERS_SQL would materialize the whole
+# union for every page instead
+IMAGES_WITH_PERFORMERS_SQL = """
+    FROM images i
+    WHERE (
+        EXISTS (SELECT 1 FROM performers_images p WHERE p.image_id = i.id)
+        OR EXISTS (
+            SELECT 1 FROM galleries_images gi
+            CROSS JOIN performers_galleries pg ON pg.gallery_id = gi.gallery_id
+            WHERE gi.image_id = i.id
+        )
+    )
+"""
+
+# Indexes the plugin adds to Stash tables, each only if no existing index already leads
+# with its columns - Stash's (item, tag) primary keys normally do
+PLUGIN_INDEXES = [
+    ("idx_images_tags_image_id", "images_tags", ["image_id"]),
+    ("idx_galleries_tags_gallery_id", "galleries_tags", ["gallery_id"]),
+    ("idx_scenes_tags_scene_id", "scenes_tags", ["scene_id"]),
+]
+
+# Indexes earlier versions created that no sync query can use - the organized filter is
+# COALESCE(organized, 0) = 0, which the partial "organized IS NOT NULL" index can't serve
+RETIRED_PLUGIN_INDEXES = ["idx_images_organized", "idx_galleries_organized", "idx_scenes_organized"]
+
+# Plugin-owned and Stash tables besides the entity tables that the sync queries touch
+QUERY_PLAN_TABLES = ["performers", "performers_tags", "tags", "tags_relations", "galleries_images",
+                     "performers_galleries", "pts_state", "pts_queue", "pts_provenance", "pts_tag_closure"]
+
+# Rows ANALYZE samples per index when the query plan check refreshes statistics
+ANALYSIS_LIMIT = 1000
+
+# Columns of the item tables a read snapshot keeps - all the filters and delta checks read
+SNAPSHOT_ITEM_COLUMNS = ["id", "organized", "updated_at"]
+
+# Bump when the change journal layout changes
+JOURNAL_VERSION = 1
+
+# Change journals kept per database - older ones are deleted when a new one is started
+JOURNAL_KEEP = 10
+
+# Task modes that write a change journal when journalChanges is on
+JOURNALED_TASKS = ["all", "bulkImages", "bulkGalleries", "bulkScenes", "applyPlan", "performers", "cleanupTags",
+                   "rollbackJournal"]
+
+# Bump when the plan file layout changes
+PLAN_VERSION = 1
+
+# Hook object type (first part of e.g. "Image.Update.Post") -> entity key
+HOOK_ENTITIES = {
+    "Image": "images",
+    "Gallery": "galleries",
+    "Scene": "scenes",
+}
+
+# Task mode -> entity key
+TASK_ENTITIES = {
+    "bulkImages": "images",
+    "bulkGalleries": "galleries",
+    "bulkScenes": "scenes",
+}
+
+# Setting that enables each entity key
+ENTITY_SETTINGS = {
+    "images": "enableImages",
+    "galleries": "enableGalleries",
+    "scenes": "enableScenes",
+}
+
+# Bump when the on-disk layout of the performer tag cache changes
+PERFORMER_TAGS_CACHE_VERSION = 1
+
+# Bump when the layout of the resolved configuration cache changes
+CONFIG_CACHE_VERSION = 1
+
+# Waiting longer than this for the write lock counts as a busy wait in the run metrics
+BUSY_WAIT_THRESHOLD_SECONDS = 0.005
+
+# How long SQLite itself waits on a locked database before a write gives up with
+# SQLITE_BUSY, and how a busy write transaction is then retried
+BUSY_TIMEOUT_MS = 5000
+BUSY_RETRIES = 6
+BUSY_BACKOFF_SECONDS = 0.1
+BUSY_BACKOFF_MAX_SECONDS = 5.0
+
+# Pause between consecutive budgeted write transactions so other writers get the lock
+WRITE_YIELD_SECONDS = 0.05
+
+# Batches the pipeline's reader threads may get ahead of the writer
+PIPELINE_QUEUE_BATCHES = 4
+
+# Bounds for the adaptive number of items written per transaction
+MIN_WRITE_CHUNK = 50
+INITIAL_WRITE_CHUNK = 500
+
+
+class Metrics:
+    """Wall time per phase and row/lock counters for one run
+
+    Phases are timed where the work happens and never nest, so on a single thread their
+    sum accounts for the run's wall time - with the pipeline, reader and writer phases
+    overlap. The summary is reported as JSON and optionally as a Prometheus textfile.
+    """
+
+    def __init__(self):
+        # threading.Lock itself, without importing threading on every hook
+        self.lock = _thread.allocate_lock()
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.phases = {}
+        self.counters = {"batches": 0, "rows_read": 0, "rows_written": 0, "commits": 0,
+                         "busy_waits": 0, "busy_wait_seconds": 0.0, "busy_retries": 0,
+                         "max_transaction_seconds": 0.0}
+        self.entities = {}
+
+    @contextmanager
+    def phase(self, name):
+        """Add the wall time of the with-block to the named phase"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def peak(self, name, value):
+        with self.lock:
+            self.counters[name] = max(self.counters.get(name, 0), value)
+
+    def summary(self):
+        return {
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            "duration_seconds": round(time.time() - self.started, 4),
+            "phases": {name: round(seconds, 4) for name, seconds in self.phases.items()},
+            "counters": {name: round(value, 4) if isinstance(value, float) else value
+                         for name, value in self.counters.items()},
+            "entities": self.entities,
+        }
+
+
+metrics = Metrics()
+
+
+class ChangeJournal:
+    """Append-only, gzipped record of the tag rows a task added and removed
+
+    Uses the sync plan's line format: a header, then one {"e", "id", "add", "remove"}
+    line per item written. Rows are recorded inside the write transaction but only reach
+    the file once it commits, so a rolled-back or retried transaction leaves no trace.
+    Each commit ends with a gzip sync flush, so the journal of an interrupted task still
+    reads back up to its last commit. Inactive (record is a no-op) until opened. A journal
+    that ends up recording nothing is deleted on close, so the newest journal is always
+    the last task that changed something.
+    """
+
+    def __init__(self):
+        self.file = None
+        self.path = None
+        self.pending = []
+        self.items = 0
+
+    @property
+    def active(self):
+        return self.file is not None
+
+    def open(self, path, header):
+        import gzip
+        self.path = path
+        self.items = 0
+        # Level 1 keeps compression off the write path - the lines are small integers anyway.
+        # Exclusive creation, so two tasks never claim the same journal name
+        self.file = gzip.open(path, "xb", compresslevel=1)
+        self.file.write((json.dumps(header) + "\n").encode())
+
+    def record(self, entity_key, changes):
+        """Note (item_id, added_tags, removed_tags) changes written in the open transaction"""
+        if self.file is not None and changes:
+            self.pending.append((entity_key, changes))
+
+    def commit(self):
+        """The transaction committed - append its changes to the journal"""
+        if not self.pending:
+            return
+        import zlib
+        with metrics.phase("journal"):
+            # Formatted by hand - the same JSON json.dumps would write, at a fraction of the cost
+            lines = [
+                f'{{"e":"{entity_key}","id":{item_id},"add":[{",".join(map(str, sorted(added)))}],'
+                f'"remove":[{",".join(map(str, sorted(removed)))}]}}'
+                for entity_key, changes in self.pending for item_id, added, removed in changes
+            ]
+            self.file.write(("\n".join(lines) + "\n").encode())
+            self.file.flush(zlib.Z_SYNC_FLUSH)
+        metrics.count("journal_items", len(lines))
+        self.items += len(lines)
+        self.pending.clear()
+
+    def discard(self):
+        """The transaction rolled back - forget its changes"""
+        self.pending.clear()
+
+    def close(self):
+        self.pending.clear()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            if self.items:
+                log.info(f"Change journal of {self.items} items written to {self.path}")
+            else:
+                os.remove(self.path)
+
+
+journal = ChangeJournal()
+
+
+class WriteBudget:
+    """Sizes write transactions so each one holds the write lock for about budget_seconds
+
+    Starts small and scales the chunk size by how the last transaction's lock hold time
+    compared with the budget - growing at most 2x per transaction, shrinking at once -
+    within MIN_WRITE_CHUNK and max_items. A budget of 0 always uses max_items.
+    """
+
+    def __init__(self, budget_seconds, max_items):
+        self.budget_seconds = budget_seconds
+        self.max_items = max_items
+        self.size = min(INITIAL_WRITE_CHUNK, max_items) if budget_seconds > 0 else max_items
+
+    def record(self, items, seconds):
+        if self.budget_seconds <= 0 or items < self.size:
+            # A short final chunk says little about how long a full one takes
+            return
+        scale = self.budget_seconds / seconds if seconds > 0 else 2.0
+        self.size = max(MIN_WRITE_CHUNK, min(self.max_items, int(self.size * min(scale, 2.0))))
+
+
+_plugin_input = None
+_stash_configuration = None  # Stash's configuration, fetched at most once per process
+_resolved_config = None  # (database path, plugin settings) from resolve_stash_config
+_performer_tags_memo = None  # (fingerprint, compact, performer -> tags map) shared by every sync in this process
+
+
+def get_plugin_input():
+    """Parse the plugin input from stdin (read once and cached, stdin can only be consumed once)"""
+    global _plugin_input
+    if _plugin_input is None:
+        try:
+            _plugin_input = json.loads(sys.stdin.read() or "{}")
+        except ValueError as e:
+            log.debug(f"Could not parse plugin input: {e}")
+            _plugin_input = {}
+    return _plugin_input
+
+
+def import_numpy():
+    """Import NumPy the first time it is needed - returns the module, or None if it isn't installed"""
+    global np, _numpy_checked
+    if not _numpy_checked:
+        _numpy_checked = True
+        try:
+            import numpy
+            np = numpy
+        except ImportError:
+            pass
+    return np
+
+
+def get_stash_configuration():
+    """Fetch Stash's configuration over GraphQL, once per process
+
+    Returns None without stashapi or a server connection. stashapi.stashapp is imported
+    here rather than at startup, since it pulls in requests and the GraphQL layer.
+    """
+    global _stash_configuration
+    if _stash_configuration is None:
+        _stash_configuration = {}
+        server_connection = get_plugin_input().get("server_connection")
+        if USE_STASH_LOG and server_connection:
+            try:
+                from stashapi.stashapp import StashInterface
+                _stash_configuration = StashInterface(server_connection).get_configuration() or {}
+            except Exception as e:
+                log.debug(f"Could not get configuration from stashapi: {e}")
+    return _stash_configuration or None
+
+
+def get_stash_config_file():
+    """Path of Stash's config.yml, from the server connection's Dir, or None if it can't be found"""
+    config_dir = (get_plugin_input().get("server_connection") or {}).get("Dir")
+    if not config_dir:
+        return None
+    path = os.path.join(config_dir, "config.yml")
+    return path if os.path.isfile(path) else None
+
+
+def read_config_cache(config_file):
+    """Load the cached (database path, plugin settings), or None if they are missing or stale"""
+    try:
+        with open(f"{config_file}.pts-config", "r", encoding="utf-8") as f:
+            cached = json.load(f)
+        stat = os.stat(config_file)
+    except (OSError, ValueError):
+        return None
+    if (cached.get("version") != CONFIG_CACHE_VERSION
+            or cached.get("config_stamp") != [stat.st_mtime_ns, stat.st_size]
+            or not os.path.exists(cached.get("database_path") or "")):
+        return None
+    return cached["database_path"], cached["plugin_settings"]
+
+
+def write_config_cache(config_file, stamp, database_path, plugin_settings):
+    """Persist the resolved configuration next to config.yml, keyed by its mtime and size before the fetch"""
+    cache_path = f"{config_file}.pts-config"
+    cache = {
+        "version": CONFIG_CACHE_VERSION,
+        "config_stamp": stamp,
+        "database_path": database_path,
+        "plugin_settings": plugin_settings,
+    }
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        log.debug(f"Could not write config cache: {e}")
+
+
+def resolve_stash_config():
+    """Return (database path, plugin settings) from Stash's configuration
+
+    Either is None if Stash's configuration isn't available. Stash rewrites config.yml
+    whenever a setting changes, so the answer is cached along with that file's mtime
+    and size, and while they match a run needs neither stashapi.stashapp nor a GraphQL
+    round trip.
+    """
+    global _resolved_config
+    if _resolved_config is not None:
+        return _resolved_config
+
+    config_file = get_stash_config_file()
+    cached = read_config_cache(config_file) if config_file else None
+    if cached is not None:
+        log.debug("Using cached Stash configuration")
+        _resolved_config = cached
+        return _resolved_config
+
+    # Stamp before fetching, so a change made during the fetch invalidates the cache
+    stamp = None
+    if config_file:
+        stat = os.stat(config_file)
+        stamp = [stat.st_mtime_ns, stat.st_size]
+    config = get_stash_configuration()
+    if config is None:
+        _resolved_config = (None, None)
+        return _resolved_config
+
+    database_path = (config.get("general") or {}).get("databasePath")
+    plugin_settings = (config.get("plugins") or {}).get("performer-tag-sync") or {}
+    if stamp and database_path:
+        write_config_cache(config_file, stamp, database_path, plugin_settings)
+    _resolved_config = (database_path, plugin_settings)
+    return _resolved_config
+
+
+def get_database_path():
+    """Find the Stash database file"""
+    # Try the Stash configuration
+    database_path, _ = resolve_stash_config()
+    if database_path:
+        return database_path
+
+    # Try common locations
+    common_paths = [
+        "/var/lib/stashapp/config/stash-go.sqlite",
+        os.path.expanduser("~/.stash/stash-go.sqlite"),
+        os.path.join(os.path.dirname(__file__), "../../stash-go.sqlite"),
+    ]
+
+    for path in common_paths:
+        if os.path.exists(path):
+            log.info(f"Found database at: {path}")
+            return path
+
+    log.error("Could not find stash-go.sqlite database file")
+    log.error("Please specify database path in plugin settings or ensure it's in a standard location")
+    sys.exit(1)
+
+
+def check_schema_version(db_path):
+    """Check database schema version for compatibility"""
+    # Use read-only connection for schema check
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    cursor = conn.cursor()
+
+    cursor.execute("SELECT version FROM schema_migrations ORDER BY version DESC LIMIT 1")
+    version = cursor.fetchone()[0]
+    conn.close()
+
+    log.info(f"Database schema version: {version}")
+
+    if version not in SUPPORTED_SCHEMA_VERSIONS:
+        msg = f"WARNING: Database schema version {version} is not in tested versions {SUPPORTED_SCHEMA_VERSIONS}"
+        if SCHEMA_WARNING_ONLY:
+            log.warning(msg)
+            log.warning("Proceeding anyway - if you encounter errors, please report the issue")
+        else:
+            log.error(msg)
+            log.error("Refusing to run on unsupported schema version to prevent data corruption")
+            sys.exit(1)
+
+    return version
+
+
+def enable_wal_mode(db_path):
+    """Enable WAL (Write-Ahead Logging) mode for better concurrent access"""
+    # Use a write connection to enable WAL
+    conn = sqlite3.connect(f"file:{db_path}?_txlock=immediate", uri=True)
+    cursor = conn.cursor()
+
+    # Check current journal mode
+    cursor.execute("PRAGMA journal_mode")
+    current_mode = cursor.fetchone()[0]
+
+    if current_mode.upper() != 'WAL':
+        log.info("Enabling WAL mode for better concurrent access...")
+        cursor.execute("PRAGMA journal_mode=WAL")
+        log.info("WAL mode enabled")
+    else:
+        log.debug("WAL mode already enabled")
+
+    # Set optimal cache size (2MB default, matches Stash)
+    cursor.execute("PRAGMA cache_size=-2000")
+
+    conn.close()
+
+
+def create_read_connection(db_path):
+    """Create a read-only database connection"""
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    # Autocommit, so writes to temp tables don't leave a read transaction open that
+    # would pin the WAL snapshot and stop checkpoints
+    conn.isolation_level = None
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+class ReadSnapshot:
+    """In-memory copy of the tables the read side of a bulk sync needs
+
+    The copy is taken in one read transaction, so every batch diffs against the same
+    consistent view however the writer's commits interleave with the reads, and no read
+    after it touches the disk. Item tables keep only SNAPSHOT_ITEM_COLUMNS; the others keep
+    their schema and rowids, so fingerprints and delta watermarks read the same as on the
+    database, but only the indexes the batch lookups use. The copy is a named shared-cache
+    memory database, so the pipeline's reader threads each connect to it with their own
+    temp tables.
+    """
+
+    def __init__(self, db_path, settings, entity_keys):
+        self.uri = f"file:pts-snapshot-{os.getpid()}-{id(self)}?mode=memory&cache=shared"
+        # The memory database lives as long as a connection to it is open
+        self.holder = self.connect()
+        with metrics.phase("snapshot"):
+            rows = self.copy(db_path, snapshot_tables(settings, entity_keys))
+        size = self.holder.execute("PRAGMA page_count").fetchone()[0] * \
+            self.holder.execute("PRAGMA page_size").fetchone()[0]
+        metrics.count("snapshot_rows", rows)
+        metrics.peak("snapshot_bytes", size)
+        log.info(f"Read snapshot: {rows} rows copied into memory ({size / (1024 * 1024):.1f} MB)")
+
+    def copy(self, db_path, tables):
+        conn = self.holder
+        conn.execute("ATTACH DATABASE ? AS source", (f"file:{db_path}?mode=ro",))
+        rows = 0
+        conn.execute("BEGIN")
+        try:
+            schema = dict(conn.execute("SELECT name, sql FROM source.sqlite_master WHERE type = 'table'").fetchall())
+            for table, (columns, indexed) in tables.items():
+                if table not in schema:
+                    continue
+                if columns:
+                    conn.execute(f"CREATE TABLE main.{table} (id INTEGER PRIMARY KEY, {', '.join(columns[1:])})")
+                    cursor = conn.execute(f"INSERT INTO main.{table} SELECT {', '.join(columns)} FROM source.{table}")
+                    rows += cursor.rowcount
+                    continue
+                conn.execute(schema[table])
+                columns = ", ".join(f'"{row[1]}"' for row in conn.execute(f"PRAGMA source.table_info({table})"))
+                if "WITHOUT ROWID" not in schema[table].upper():
+                    columns = f"rowid, {columns}"
+                cursor = conn.execute(f"INSERT INTO main.{table} ({columns}) SELECT {columns} FROM source.{table}")
+                rows += cursor.rowcount
+                # Indexed after the rows are in, which is cheaper than maintaining the index per row
+                for column in indexed:
+                    conn.execute(f"CREATE INDEX main.pts_snapshot_{table}_{column} ON {table} ({column})")
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.execute("DETACH DATABASE source")
+        return rows
+
+    def connect(self):
+        """A read connection on the snapshot, with its own temp tables"""
+        conn = sqlite3.connect(self.uri, uri=True)
+        conn.isolation_level = None
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def close(self):
+        self.holder.close()
+
+
+def snapshot_tables(settings, entity_keys):
+    """{table: (columns, indexed)} for the tables the read side of a bulk sync reads
+
+    columns None copies the whole table with its schema. indexed lists the columns that
+    need an index besides the primary key - only galleries_images, which batches look up
+    by image while its key leads with the gallery.
+    """
+    whole = (None, [])
+    tables = {"performers": (["id", "updated_at"], []), "performers_tags": whole, "pts_state": whole}
+    if settings["includeParentTags"]:
+        tables.update(tags_relations=whole, pts_tag_closure=whole)
+    for entity_key in entity_keys:
+        entity = ENTITIES[entity_key]
+        tables.update({entity["table"]: (SNAPSHOT_ITEM_COLUMNS, []), entity["tags_table"]: whole,
+                       entity["performers_table"]: whole})
+        if inherits_gallery_performers(entity, settings["inheritGalleryPerformers"]):
+            tables.update(galleries=(SNAPSHOT_ITEM_COLUMNS, []), galleries_images=(None, ["image_id"]),
+                          performers_galleries=whole)
+    return tables
+
+
+def open_read_connection(db_path, snapshot=None):
+    """Read connection on the snapshot if one was taken, else on the database"""
+    return snapshot.connect() if snapshot else create_read_connection(db_path)
+
+
+def create_write_connection(db_path):
+    """Create a write connection with immediate transaction lock"""
+    conn = sqlite3.connect(f"file:{db_path}?_txlock=immediate", uri=True)
+    # _txlock is a Go driver option that Python's sqlite3 ignores - ask for BEGIN IMMEDIATE
+    # here so a transaction that reads before it writes can't fail to upgrade its lock
+    conn.isolation_level = "IMMEDIATE"
+    # Wait for Stash's own writes, then let run_write_transaction back off and retry
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    # Set optimal cache size
+    conn.execute("PRAGMA cache_size=-2000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+def begin_write(conn):
+    """Open the write transaction explicitly, recording how long the write lock took to get
+
+    Python's sqlite3 would otherwise issue BEGIN IMMEDIATE inside the first write
+    statement, folding any wait on another writer into the write time.
+    """
+    if conn.in_transaction:
+        return
+    start = time.perf_counter()
+    conn.execute("BEGIN IMMEDIATE")
+    waited = time.perf_counter() - start
+    if waited > BUSY_WAIT_THRESHOLD_SECONDS:
+        metrics.count("busy_waits")
+        metrics.count("busy_wait_seconds", waited)
+
+
+def commit_write(conn):
+    """Commit the write transaction, timed as the commit phase"""
+    with metrics.phase("commit"):
+        conn.commit()
+    metrics.count("commits")
+    journal.commit()
+
+
+def is_busy_error(error):
+    """True for SQLITE_BUSY / SQLITE_LOCKED - another connection holds the lock"""
+    message = str(error).lower()
+    return "locked" in message or "busy" in message
+
+
+def run_write_transaction(conn, write):
+    """Run write() in its own write transaction, retrying with backoff while the database is busy
+
+    Returns (write()'s result, seconds the write lock was held). On SQLITE_BUSY the
+    transaction is rolled back and retried after an exponentially growing, jittered
+    sleep, so a sync yields to Stash's own writes instead of failing.
+    """
+    for attempt in range(BUSY_RETRIES + 1):
+        try:
+            begin_write(conn)
+            start = time.perf_counter()
+            with metrics.phase("write"):
+                result = write()
+            commit_write(conn)
+            held = time.perf_counter() - start
+            metrics.peak("max_transaction_seconds", round(held, 4))
+            return result, held
+        except sqlite3.OperationalError as e:
+            journal.discard()
+            if not is_busy_error(e) or attempt == BUSY_RETRIES:
+                raise
+            conn.rollback()
+            import random
+            delay = min(BUSY_BACKOFF_MAX_SECONDS, BUSY_BACKOFF_SECONDS * 2 ** attempt) * random.uniform(0.5, 1.0)
+            metrics.count("busy_retries")
+            log.debug(f"Database busy ({e}), retrying in {delay:.2f}s")
+            time.sleep(delay)
+
+
+def write_budgeted(conn, budget, units, write_chunk, checkpoint=None):
+    """Write units in consecutive transactions sized by budget - returns the sum of write_chunk's results
+
+    checkpoint, if given, is called inside each transaction after the writes with the
+    chunk's last unit (None for the final chunk), so progress commits atomically with
+    the rows it describes.
+    """
+    total = 0
+    start = 0
+    while start < len(units):
+        chunk = units[start:start + budget.size]
+        if start and budget.budget_seconds > 0:
+            # Leave the lock free for a moment - a writer waiting in SQLite's busy handler
+            # only polls every few tens of ms and would keep missing back-to-back commits
+            time.sleep(WRITE_YIELD_SECONDS)
+
+        def write():
+            result = write_chunk(chunk)
+            if checkpoint:
+                checkpoint(chunk[-1] if start + len(chunk) < len(units) else None)
+            return result
+
+        result, held = run_write_transaction(conn, write)
+        budget.record(len(chunk), held)
+        total += result
+        start += len(chunk)
+    return total
+
+
+def load_index_columns(cursor, table):
+    """Map each index on table to (columns, unique, partial)"""
+    cursor.execute(f"PRAGMA index_list({table})")
+    indexes = {name: (bool(unique), bool(partial)) for _, name, unique, _, partial in cursor.fetchall()}
+    columns = {}
+    for name, (unique, partial) in indexes.items():
+        cursor.execute(f"PRAGMA index_info({name})")
+        columns[name] = ([row[2] for row in cursor.fetchall()], unique, partial)
+    return columns
+
+
+def find_covering_index(indexes, columns, exclude=None):
+    """Name of an index (from load_index_columns) whose leading columns are columns, or None"""
+    for name, (index_columns, _, partial) in indexes.items():
+        if name != exclude and not partial and index_columns[:len(columns)] == columns:
+            return name
+    return None
+
+
+def create_indexes_if_needed(db_path):
+    """Create the plugin's indexes where no existing index already serves the same lookups"""
+    # Use write connection for creating indexes
+    conn = create_write_connection(db_path)
+    cursor = conn.cursor()
+
+    for name, table, columns in PLUGIN_INDEXES:
+        try:
+            covering = find_covering_index(load_index_columns(cursor, table), columns, exclude=name)
+            if covering:
+                log.debug(f"Skipping index {name}: {covering} already covers {table}({', '.join(columns)})")
+                continue
+            log.debug(f"Creating index {name}...")
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table}({', '.join(columns)})")
+            log.debug(f"Index {name} created or already exists")
+        except sqlite3.Error as e:
+            log.warning(f"Could not create index {name}: {e}")
+
+    conn.commit()
+    conn.close()
+    log.info("Performance indexes verified")
+
+
+def merge_settings(user_settings):
+    """Overlay user settings on the defaults, normalizing the enumerated ones"""
+    settings = DEFAULT_SETTINGS.copy()
+    settings.update(user_settings)
+
+    # Ensure tagMode is uppercase
+    settings["tagMode"] = settings.get("tagMode", "ADD").upper()
+    if settings["tagMode"] not in ["ADD", "SET"]:
+        log.warning(f"Invalid tagMode '{settings['tagMode']}', defaulting to ADD")
+        settings["tagMode"] = "ADD"
+
+    settings["engine"] = settings.get("engine", "SQL").upper()
+    if settings["engine"] not in ["SQL", "PYTHON"]:
+        log.warning(f"Invalid engine '{settings['engine']}', defaulting to SQL")
+        settings["engine"] = "SQL"
+    return settings
+
+
+def load_settings():
+    """Load plugin settings from the Stash configuration or use defaults"""
+    try:
+        _, user_settings = resolve_stash_config()
+        if user_settings is not None:
+            settings = merge_settings(user_settings)
+            log.info(f"Settings loaded: {settings}")
+            return settings
+    except Exception as e:
+        log.debug(f"Could not load settings from stash: {e}")
+
+    log.info("Using default settings")
+    return DEFAULT_SETTINGS.copy()
+
+
+def get_exclusion_tag_ids(db_path, settings):
+    """Get the IDs of the excludeTag tags (comma-separated names) for the exclusion filter
+
+    With excludeChildTags, every descendant of those tags in tags_relations is added.
+    Returns a sorted list, empty if no exclusion tag is configured or found.
+    """
+    tag_names = [name.strip() for name in (settings.get("excludeTag") or "").split(",") if name.strip()]
+    if not tag_names:
+        return []
+
+    # Use read-only connection for tag lookup
+    conn = create_read_connection(db_path)
+    cursor = conn.cursor()
+    tag_ids = set()
+    for tag_name in tag_names:
+        cursor.execute("SELECT id FROM tags WHERE name = ? COLLATE NOCASE", (tag_name,))
+        row = cursor.fetchone()
+        if row:
+            log.info(f"Exclusion tag '{tag_name}' found with ID {row[0]}")
+            tag_ids.add(row[0])
+        else:
+            log.warning(f"Exclusion tag '{tag_name}' not found")
+
+    if tag_ids and settings.get("excludeChildTags"):
+        # Walk down the hierarchy once here, so the filter itself stays a flat set lookup
+        pending = list(tag_ids)
+        while pending:
+            cursor.execute("SELECT child_id FROM tags_relations WHERE parent_id = ?", (pending.pop(),))
+            for (child_id,) in cursor.fetchall():
+                if child_id not in tag_ids:
+                    tag_ids.add(child_id)
+                    pending.append(child_id)
+        log.info(f"Excluding {len(tag_ids)} tags including child tags")
+    conn.close()
+    return sorted(tag_ids)
+
+
+def load_state(cursor, key):
+    """Read a value from the plugin-owned state table"""
+    try:
+        cursor.execute("SELECT value FROM pts_state WHERE key = ?", (key,))
+    except sqlite3.OperationalError:
+        # Table not created yet - nothing has been persisted
+        return None
+    row = cursor.fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def save_state(cursor, key, value):
+    """Write a value to the plugin-owned state table (caller commits)"""
+    cursor.execute("CREATE TABLE IF NOT EXISTS pts_state (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+    cursor.execute("INSERT OR REPLACE INTO pts_state (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+
+def delete_state(cursor, key):
+    """Remove a value from the plugin-owned state table (caller commits)"""
+    try:
+        cursor.execute("DELETE FROM pts_state WHERE key = ?", (key,))
+    except sqlite3.OperationalError:
+        # Table not created yet - nothing to remove
+        pass
+
+
+def finish_sync_state(conn, entity_key, checkpoint_key, watermark):
+    """Clear the resume checkpoint and advance the delta watermark (if any) once every batch is written"""
+    def finish():
+        delete_state(conn.cursor(), checkpoint_key)
+        if watermark:
+            save_state(conn.cursor(), f"watermark:{entity_key}", watermark)
+    run_write_transaction(conn, finish)
+
+
+def read_watermark(cursor, entity, settings):
+    """Snapshot the change markers a later delta run compares against"""
+    cursor.execute(f"""
+        SELECT
+            (SELECT MAX(julianday(updated_at)) FROM {entity['table']}),
+            (SELECT MAX(rowid) FROM {entity['performers_table']}),
+            (SELECT MAX(julianday(updated_at)) FROM performers),
+            (SELECT MAX(rowid) FROM performers_tags)
+    """)
+    item_updated, link_rowid, performer_updated, performer_tag_rowid = cursor.fetchone()
+    delta_settings = {key: settings.get(key) for key in DELTA_SETTINGS_KEYS}
+    if settings.get("includeParentTags") or (settings.get("excludeChildTags") and settings.get("excludeTag")):
+        # A change to the tag hierarchy can change any item's tags or whether it is
+        # excluded, without touching the item itself, so it forces a full sync
+        delta_settings["tag_relations"] = tag_relations_fingerprint(cursor)
+    watermark = {
+        "settings": delta_settings,
+        "item_updated_at": item_updated or 0,
+        "link_rowid": link_rowid or 0,
+        "performer_updated_at": performer_updated or 0,
+        "performer_tag_rowid": performer_tag_rowid or 0,
+    }
+    if inherits_gallery_performers(entity, settings.get("inheritGalleryPerformers")):
+        cursor.execute("""
+            SELECT (SELECT MAX(julianday(updated_at)) FROM galleries), (SELECT MAX(rowid) FROM galleries_images)
+        """)
+        gallery_updated, gallery_image_rowid = cursor.fetchone()
+        watermark["gallery_updated_at"] = gallery_updated or 0
+        watermark["gallery_image_rowid"] = gallery_image_rowid or 0
+    return watermark
+
+
+def load_delta_candidates(cursor, entity, watermark, gallery_performers=False):
+    """Fill temp.pts_candidates with items that may have changed since the watermark
+
+    An item is a candidate when it was updated itself (performers added or removed through
+    Stash bump updated_at), gained a performer link, or one of its performers was updated
+    or gained a tag. With gallery_performers, an image is also a candidate when one of its
+    galleries was updated or it was added to a gallery.
+    """
+    id_column = entity["id_column"]
+    performers_table = entity["performers_table"]
+    source = item_performers_source(entity, gallery_performers)
+    params = [
+        watermark["item_updated_at"],
+        watermark["link_rowid"],
+        watermark["performer_updated_at"],
+        watermark["performer_tag_rowid"],
+    ]
+    gallery_sql = ""
+    if inherits_gallery_performers(entity, gallery_performers):
+        gallery_sql = """
+        UNION
+        SELECT gi.image_id
+        FROM galleries g
+        INNER JOIN galleries_images gi ON gi.gallery_id = g.id
+        WHERE julianday(g.updated_at) > ?
+        UNION
+        SELECT image_id FROM galleries_images WHERE rowid > ?
+        """
+        params += [watermark["gallery_updated_at"], watermark["gallery_image_rowid"]]
+
+    cursor.execute("DROP TABLE IF EXISTS temp.pts_candidates")
+    cursor.execute("CREATE TEMP TABLE pts_candidates (id INTEGER PRIMARY KEY)")
+    cursor.execute(f"""
+        INSERT INTO temp.pts_candidates (id)
+        SELECT id FROM {entity['table']} WHERE julianday(updated_at) > ?
+        UNION
+        SELECT {id_column} FROM {performers_table} WHERE rowid > ?
+        UNION
+        SELECT p.{id_column}
+        FROM {source} p
+        INNER JOIN performers pf ON pf.id = p.performer_id
+        WHERE julianday(pf.updated_at) > ?
+        UNION
+        SELECT p.{id_column}
+        FROM {source} p
+        INNER JOIN performers_tags pt ON pt.performer_id = p.performer_id
+        WHERE pt.rowid > ?
+        {gallery_sql}
+    """, params)
+    return cursor.rowcount
+
+
+def load_excluded_tags(cursor, exclusion_tag_ids):
+    """Load the exclusion tag IDs into temp.pts_excluded_tags on the cursor's connection"""
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS pts_excluded_tags (id INTEGER PRIMARY KEY)")
+    cursor.execute("DELETE FROM temp.pts_excluded_tags")
+    cursor.executemany("INSERT OR IGNORE INTO temp.pts_excluded_tags (id) VALUES (?)",
+                       ((tag_id,) for tag_id in exclusion_tag_ids))
+
+
+def build_filter_sql(cursor, entity, settings, exclusion_tag_ids):
+    """Build the WHERE clause applying the organized/tag exclusion filters
+
+    The exclusion tags are loaded into a temp table on the cursor's connection, so the
+    clause is only valid on that connection.
+    """
+    alias = entity["alias"]
+    where_clauses = []
+    params = []
+
+    if settings["excludeOrganized"]:
+        # Exclude organized items (1/true), keep unorganized items (0/false or NULL)
+        where_clauses.append(f"COALESCE({alias}.organized, 0) = 0")
+
+    if exclusion_tag_ids:
+        # One anti-join however many tags are excluded: range-scan the item's own tags on
+        # the (item, tag) primary key and look each up in the excluded set. The unary +
+        # keeps SQLite from probing the key once per excluded tag instead
+        load_excluded_tags(cursor, exclusion_tag_ids)
+        where_clauses.append(f"""NOT EXISTS (
+            SELECT 1 FROM {entity['tags_table']} xt
+            WHERE xt.{entity['id_column']} = {alias}.id AND +xt.tag_id IN (SELECT id FROM temp.pts_excluded_tags)
+        )""")
+
+    where_sql = " AND " + " AND ".join(where_clauses) if where_clauses else ""
+    return where_sql, params
+
+
+def count_items(cursor, entity, where_sql, params, gallery_performers=False):
+    """Count the items with performers that pass the filters"""
+    with metrics.phase("id_scan"):
+        if inherits_gallery_performers(entity, gallery_performers):
+            cursor.execute(f"SELECT COUNT(*) {IMAGES_WITH_PERFORMERS_SQL} {where_sql}", params)
+            return cursor.fetchone()[0]
+        cursor.execute(f"""
+            SELECT COUNT(DISTINCT p.{entity['id_column']})
+            FROM {entity['performers_table']} p
+            INNER JOIN {entity['table']} {entity['alias']} ON {entity['alias']}.id = p.{entity['id_column']}
+            {where_sql}
+        """, params)
+        return cursor.fetchone()[0]
+
+
+def iter_item_batches(cursor, entity, where_sql, params, batch_size, after_id=0, gallery_performers=False):
+    """Yield batches of item IDs with performers, in ID order, paging with WHERE id > last_id
+
+    Only one batch of IDs is held at a time, so memory stays flat however large the
+    library is, and the last ID of a finished batch is a resume point.
+    """
+    id_column = entity["id_column"]
+    if inherits_gallery_performers(entity, gallery_performers):
+        sql = f"SELECT i.id {IMAGES_WITH_PERFORMERS_SQL} {where_sql} AND i.id > ? ORDER BY i.id LIMIT ?"
+    else:
+        sql = f"""
+            SELECT DISTINCT p.{id_column}
+            FROM {entity['performers_table']} p
+            INNER JOIN {entity['table']} {entity['alias']} ON {entity['alias']}.id = p.{id_column}
+            {where_sql}
+            WHERE p.{id_column} > ?
+            ORDER BY p.{id_column}
+            LIMIT ?
+        """
+    last_id = after_id
+    while True:
+        with metrics.phase("id_scan"):
+            cursor.execute(sql, params + [last_id, batch_size])
+            batch_ids = [row[0] for row in cursor.fetchall()]
+        if not batch_ids:
+            return
+        yield batch_ids
+        if len(batch_ids) < batch_size:
+            return
+        last_id = batch_ids[-1]
+
+
+class PerformerTagMap:
+    """Compact performer -> tags map in CSR form
+
+    ids holds the sorted performer IDs, and the tags of ids[i] are
+    tags[offsets[i]:offsets[i + 1]], sorted. That is 16 bytes per performer and 8 per
+    performer tag, against a set object per performer in the dict form. Uses NumPy
+    arrays when NumPy is installed (so diff_batch can work on whole batches), else
+    array("q"). get() and len() match the dict, so either form can be passed around.
+    """
+
+    def __init__(self, pairs):
+        """Build from flat (performer, tag, performer, tag, ...) pairs sorted by performer then tag"""
+        if import_numpy() is not None:
+            pairs = np.frombuffer(pairs, dtype=np.int64).reshape(-1, 2)
+            self.ids, starts = np.unique(pairs[:, 0], return_index=True)
+            self.offsets = np.append(starts, len(pairs)).astype(np.int64)
+            self.tags = pairs[:, 1].copy()
+            return
+
+        self.ids = array("q")
+        self.offsets = array("q")
+        self.tags = array("q", pairs[1::2])
+        for index, perf_id in enumerate(pairs[0::2]):
+            if not self.ids or self.ids[-1] != perf_id:
+                self.ids.append(perf_id)
+                self.offsets.append(index)
+        self.offsets.append(len(self.tags))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get(self, perf_id, default=()):
+        index = bisect_left(self.ids, perf_id)
+        if index < len(self.ids) and self.ids[index] == perf_id:
+            return self.tags[self.offsets[index]:self.offsets[index + 1]]
+        return default
+
+
+def performer_tags_source(parent_tags):
+    """Table expression to read performer -> tag rows from, with or without parent tags"""
+    return PARENT_TAGS_SQL if parent_tags else "performers_tags"
+
+
+def inherits_gallery_performers(entity, gallery_performers):
+    """Whether the items of entity take on the performers of their galleries - only images can"""
+    return bool(gallery_performers) and entity["table"] == "images"
+
+
+def item_performers_source(entity, gallery_performers):
+    """The table (or subquery) holding the entity's (item, performer) links"""
+    if inherits_gallery_performers(entity, gallery_performers):
+        return GALLERY_IMAGE_PERFORMERS_SQL
+    return entity["performers_table"]
+
+
+def batch_performers_sql(entity, gallery_performers=False):
+    """Subquery of the (item, performer) links of the items in temp.pts_batch
+
+    With gallery_performers, images are also linked to the performers of their galleries.
+    Every branch starts from the batch table, so each stays an indexed join however many
+    images a gallery holds.
+    """
+    id_column = entity["id_column"]
+    sql = f"""
+        SELECT p.{id_column} AS {id_column}, p.performer_id AS performer_id
+        FROM temp.pts_batch b
+        CROSS JOIN {entity['performers_table']} p ON p.{id_column} = b.id
+    """
+    if inherits_gallery_performers(entity, gallery_performers):
+        sql += """
+        UNION ALL
+        SELECT gi.image_id, pg.performer_id
+        FROM temp.pts_batch b
+        CROSS JOIN galleries_images gi ON gi.image_id = b.id
+        CROSS JOIN performers_galleries pg ON pg.gallery_id = gi.gallery_id
+        """
+    return f"({sql})"
+
+
+def load_performer_tag_pairs(cursor, parent_tags=False):
+    """Fetch all performer -> tag mappings as flat (performer, tag, ...) pairs, sorted"""
+    cursor.execute(f"""
+        SELECT DISTINCT performer_id, tag_id FROM {performer_tags_source(parent_tags)}
+        ORDER BY performer_id, tag_id
+    """)
+    pairs = array("q")
+    pairs.extend(chain.from_iterable(cursor))
+    return pairs
+
+
+def performer_tags_from_pairs(pairs):
+    """Build the dict form of the performer -> tags map from flat sorted pairs"""
+    performer_tags = {}
+    values = iter(pairs)
+    for perf_id, tag_id in zip(values, values):
+        if perf_id not in performer_tags:
+            performer_tags[perf_id] = set()
+        performer_tags[perf_id].add(tag_id)
+    return performer_tags
+
+
+def load_performer_tags(cursor):
+    """Fetch all performer -> tags mappings"""
+    return performer_tags_from_pairs(load_performer_tag_pairs(cursor))
+
+
+def performer_tags_fingerprint(cursor):
+    """Cheap change detector for performers_tags: row count, max rowid and an order-independent checksum"""
+    cursor.execute("""
+        SELECT COUNT(*), COALESCE(MAX(rowid), 0),
+               COALESCE(SUM(((performer_id * 31 + tag_id) * (tag_id * 17 + performer_id + 1)) % 1000000007), 0)
+        FROM performers_tags
+    """)
+    return list(cursor.fetchone())
+
+
+def tag_relations_fingerprint(cursor):
+    """Cheap change detector for tags_relations, computed like performer_tags_fingerprint"""
+    cursor.execute("""
+        SELECT COUNT(*), COALESCE(MAX(rowid), 0),
+               COALESCE(SUM(((parent_id * 31 + child_id) * (child_id * 17 + parent_id + 1)) % 1000000007), 0)
+        FROM tags_relations
+    """)
+    return list(cursor.fetchone())
+
+
+def build_tag_closure(cursor):
+    """Compute every ancestor of every tag with a parent from tags_relations
+
+    Walks the hierarchy once from the roots down, so each tag's ancestors are its
+    parents plus their already computed ancestors - linear in the size of the closure
+    however deep the hierarchy is. Returns {tag_id: set of ancestor IDs}.
+    """
+    parents = {}
+    children = {}
+    cursor.execute("SELECT child_id, parent_id FROM tags_relations")
+    for child_id, parent_id in cursor:
+        parents.setdefault(child_id, []).append(parent_id)
+        children.setdefault(parent_id, []).append(child_id)
+
+    waiting = {tag_id: len(tag_parents) for tag_id, tag_parents in parents.items()}
+    ready = [tag_id for tag_id in children if tag_id not in parents]
+    ancestors = {}
+    while ready:
+        tag_id = ready.pop()
+        tag_ancestors = set()
+        for parent_id in parents.get(tag_id, ()):
+            tag_ancestors.add(parent_id)
+            tag_ancestors.update(ancestors.get(parent_id, ()))
+        if tag_ancestors:
+            ancestors[tag_id] = tag_ancestors
+        for child_id in children.get(tag_id, ()):
+            waiting[child_id] -= 1
+            if not waiting[child_id]:
+                ready.append(child_id)
+
+    # Stash refuses to create cycles, but tags caught in one would never become
+    # ready above - walk their parents directly instead
+    for tag_id in parents.keys() - ancestors.keys():
+        tag_ancestors = set()
+        pending = list(parents[tag_id])
+        while pending:
+            parent_id = pending.pop()
+            if parent_id not in tag_ancestors:
+                tag_ancestors.add(parent_id)
+                pending.extend(parents.get(parent_id, ()))
+        ancestors[tag_id] = tag_ancestors
+    return ancestors
+
+
+def ensure_tag_closure(db_path, settings):
+    """Rebuild pts_tag_closure if includeParentTags is on and tags_relations changed since the last build
+
+    The tags_relations fingerprint the table was built from is kept in pts_state, so
+    checking costs one aggregate over tags_relations and the rebuild only runs after
+    the hierarchy was edited.
+    """
+    if not settings.get("includeParentTags"):
+        return
+
+    conn = create_write_connection(db_path)
+    cursor = conn.cursor()
+    with metrics.phase("map_build"):
+        fingerprint = tag_relations_fingerprint(cursor)
+        if load_state(cursor, "tag_closure") == fingerprint:
+            conn.close()
+            return
+
+        # Compute outside the write lock, and only again under it if the hierarchy changed in between
+        log.info("Building the tag hierarchy closure...")
+        ancestors = build_tag_closure(cursor)
+
+        def rebuild():
+            current = tag_relations_fingerprint(cursor)
+            closure = ancestors if current == fingerprint else build_tag_closure(cursor)
+            cursor.execute(TAG_CLOSURE_TABLE_SQL)
+            rows = store_tag_closure(cursor, "main.pts_tag_closure", closure)
+            save_state(cursor, "tag_closure", current)
+            return rows
+
+        rows, _ = run_write_transaction(conn, rebuild)
+    conn.close()
+    log.info(f"Tag hierarchy closure built - {rows} (tag, ancestor) pairs")
+
+
+def store_tag_closure(cursor, table, closure):
+    """Replace the rows of a tag closure table with the closure from build_tag_closure - returns the ancestor pairs"""
+    cursor.execute(f"DELETE FROM {table}")
+    cursor.executemany(f"INSERT INTO {table} (tag_id, ancestor_id) VALUES (?, ?)", (
+        (tag_id, ancestor_id) for tag_id in sorted(closure)
+        for ancestor_id in sorted(closure[tag_id] | {tag_id})))
+    return sum(map(len, closure.values()))
+
+
+def use_temp_tag_closure(cursor, settings):
+    """Read-only ensure_tag_closure: if pts_tag_closure is missing or stale, build it in a temp table
+
+    Unqualified table names resolve to temp tables first, so PARENT_TAGS_SQL on this
+    cursor's connection reads the temp copy while the database is left untouched - for
+    tasks that must not take the write lock.
+    """
+    if not settings.get("includeParentTags"):
+        return
+    with metrics.phase("map_build"):
+        if load_state(cursor, "tag_closure") == tag_relations_fingerprint(cursor):
+            return
+        log.info("Building the tag hierarchy closure in memory...")
+        closure = build_tag_closure(cursor)
+        cursor.execute(TAG_CLOSURE_TABLE_SQL.replace("pts_tag_closure", "temp.pts_tag_closure", 1))
+        rows = store_tag_closure(cursor, "temp.pts_tag_closure", closure)
+    log.info(f"Tag hierarchy closure built - {rows} (tag, ancestor) pairs")
+
+
+def read_performer_tags_cache(cache_path, fingerprint):
+    """Load the cached performer -> tag pairs, or None if they are missing or stale"""
+    try:
+        with open(cache_path, "rb") as f:
+            header = json.loads(f.readline())
+            if (header.get("version") != PERFORMER_TAGS_CACHE_VERSION
+                    or header.get("byteorder") != sys.byteorder
+                    or header.get("fingerprint") != fingerprint):
+                return None
+            pairs = array("q")
+            pairs.frombytes(f.read())
+    except (OSError, ValueError):
+        return None
+    return pairs
+
+
+def write_performer_tags_cache(cache_path, fingerprint, pairs):
+    """Persist the performer -> tag pairs as a JSON header line followed by the packed pairs"""
+    header = {"version": PERFORMER_TAGS_CACHE_VERSION, "byteorder": sys.byteorder, "fingerprint": fingerprint}
+
+    # Write to a temp file and rename so a concurrent reader never sees a partial cache
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(json.dumps(header).encode() + b"\n")
+            pairs.tofile(f)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        log.debug(f"Could not write performer tag cache {cache_path}: {e}")
+
+
+def get_performer_tags(cursor, db_path, compact=False, parent_tags=False):
+    """Return the performer -> tags map, rebuilding it only when performers_tags has changed
+
+    The map is shared by every sync in this process and persisted next to the database,
+    so later runs and hook drains skip the query while the fingerprint still matches.
+    compact returns a PerformerTagMap instead of a dict of sets. parent_tags expands
+    each performer's tags with their ancestors from pts_tag_closure (see ensure_tag_closure).
+    """
+    global _performer_tags_memo
+    with metrics.phase("map_build"):
+        fingerprint = performer_tags_fingerprint(cursor)
+        if parent_tags:
+            fingerprint.append(tag_relations_fingerprint(cursor))
+        if _performer_tags_memo is not None and _performer_tags_memo[:2] == (fingerprint, compact):
+            return _performer_tags_memo[2]
+
+        cache_path = f"{db_path}.pts-performer-tags"
+        pairs = read_performer_tags_cache(cache_path, fingerprint)
+        if pairs is None:
+            log.info("Fetching performer tag mappings...")
+            pairs = load_performer_tag_pairs(cursor, parent_tags)
+            write_performer_tags_cache(cache_path, fingerprint, pairs)
+        else:
+            log.info("Loaded performer tag mappings from cache")
+
+        performer_tags = PerformerTagMap(pairs) if compact else performer_tags_from_pairs(pairs)
+        _performer_tags_memo = (fingerprint, compact, performer_tags)
+        return performer_tags
+
+
+def load_batch(cursor, item_ids):
+    """Load a batch of item IDs into temp.pts_batch on the cursor's connection
+
+    The per-batch lookups join against this table instead of binding an IN (?, ?, ...)
+    list, so batch size isn't capped by SQLITE_MAX_VARIABLE_NUMBER and each lookup is an
+    indexed join. Those joins use CROSS JOIN, which in SQLite pins the batch table as the
+    outer loop - the planner has no statistics for it and would otherwise scan the
+    Stash table and probe the batch.
+    """
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS pts_batch (id INTEGER PRIMARY KEY)")
+    cursor.execute("DELETE FROM temp.pts_batch")
+    cursor.executemany("INSERT OR IGNORE INTO temp.pts_batch (id) VALUES (?)", ((item_id,) for item_id in item_ids))
+
+
+def load_batch_performers(cursor, entity, gallery_performers=False):
+    """Map each item in temp.pts_batch to its performers"""
+    id_column = entity["id_column"]
+    cursor.execute(f"SELECT p.{id_column}, p.performer_id FROM {batch_performers_sql(entity, gallery_performers)} p")
+    item_performers = {}
+    for item_id, perf_id in cursor:
+        if item_id not in item_performers:
+            item_performers[item_id] = set()
+        item_performers[item_id].add(perf_id)
+    return item_performers
+
+
+def load_batch_tags(cursor, entity):
+    """Map each item in temp.pts_batch to its current tags"""
+    id_column = entity["id_column"]
+    cursor.execute(f"""
+        SELECT t.{id_column}, t.tag_id
+        FROM temp.pts_batch b
+        CROSS JOIN {entity['tags_table']} t ON t.{id_column} = b.id
+    """)
+    item_tags = {}
+    for item_id, tag_id in cursor:
+        if item_id not in item_tags:
+            item_tags[item_id] = set()
+        item_tags[item_id].add(tag_id)
+    return item_tags
+
+
+def load_item_performer_tags(cursor, entity, parent_tags=False, gallery_performers=False):
+    """Fetch the performer -> tags mappings for the performers of the items in temp.pts_batch only"""
+    cursor.execute(f"""
+        SELECT DISTINCT pt.performer_id, pt.tag_id
+        FROM {batch_performers_sql(entity, gallery_performers)} p
+        CROSS JOIN {performer_tags_source(parent_tags)} pt ON pt.performer_id = p.performer_id
+    """)
+    performer_tags = {}
+    for perf_id, tag_id in cursor:
+        if perf_id not in performer_tags:
+            performer_tags[perf_id] = set()
+        performer_tags[perf_id].add(tag_id)
+    return performer_tags
+
+
+def diff_batch(read_cursor, entity, batch_ids, performer_tags, tag_mode, gallery_performers=False):
+    """Work out which tag rows each item in a batch needs added and removed
+
+    ADD mode only adds the performer tags an item is missing. SET mode also removes
+    tags that aren't performer tags, but leaves items whose performers have no tags
+    alone. Returns (changes, unchanged), where changes is a list of
+    (item_id, tags_to_add, tags_to_remove) for items that need writes. Expects
+    batch_ids loaded into temp.pts_batch on the read connection.
+    """
+    if np is not None and isinstance(performer_tags, PerformerTagMap):
+        return diff_batch_arrays(read_cursor, entity, performer_tags, tag_mode, gallery_performers)
+
+    # Get the batch's performers and existing tags (use read connection)
+    with metrics.phase("read"):
+        item_performers = load_batch_performers(read_cursor, entity, gallery_performers)
+        existing = load_batch_tags(read_cursor, entity)
+
+    with metrics.phase("compute"):
+        metrics.count("rows_read", sum(map(len, item_performers.values())) + sum(map(len, existing.values())))
+        changes = []
+        unchanged = 0
+        for item_id in batch_ids:
+            perfs = item_performers.get(item_id, set())
+            target_tags = set()
+            for perf_id in perfs:
+                target_tags.update(performer_tags.get(perf_id, set()))
+
+            if not target_tags:
+                continue
+
+            existing_tags = existing.get(item_id, set())
+            new_tags = target_tags - existing_tags
+            removed_tags = existing_tags - target_tags if tag_mode == "SET" else set()
+            if new_tags or removed_tags:
+                changes.append((item_id, new_tags, removed_tags))
+            else:
+                unchanged += 1
+
+    return changes, unchanged
+
+
+def fetch_pairs(cursor, sql):
+    """Run a two-column integer query and return the rows as an (n, 2) int64 array"""
+    cursor.execute(sql)
+    return np.fromiter(chain.from_iterable(cursor), dtype=np.int64).reshape(-1, 2)
+
+
+def diff_batch_arrays(read_cursor, entity, performer_tags, tag_mode, gallery_performers=False):
+    """diff_batch for a NumPy-backed PerformerTagMap: the whole batch as array operations
+
+    Each (item, tag) pair is packed into one int64 key (item << 32 | tag), so target
+    tags, existing tags and their differences are sorted-array unions and set
+    differences instead of a set per item.
+    """
+    id_column = entity["id_column"]
+    with metrics.phase("read"):
+        links = fetch_pairs(read_cursor, f"""
+            SELECT p.{id_column}, p.performer_id FROM {batch_performers_sql(entity, gallery_performers)} p
+        """)
+        existing = fetch_pairs(read_cursor, f"""
+            SELECT t.{id_column}, t.tag_id
+            FROM temp.pts_batch b
+            CROSS JOIN {entity['tags_table']} t ON t.{id_column} = b.id
+        """)
+
+    with metrics.phase("compute"):
+        metrics.count("rows_read", len(links) + len(existing))
+
+        # Find each link's performer in the map, dropping performers without tags
+        ids, offsets = performer_tags.ids, performer_tags.offsets
+        index = np.minimum(np.searchsorted(ids, links[:, 1]), max(len(ids) - 1, 0))
+        found = ids[index] == links[:, 1] if len(ids) else np.zeros(len(links), dtype=bool)
+        items, index = links[found, 0], index[found]
+
+        # Expand every link to one (item, tag) pair per tag of its performer
+        starts = offsets[index]
+        counts = offsets[index + 1] - starts
+        positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - starts, counts)
+        target = np.unique((np.repeat(items, counts) << 32) | performer_tags.tags[positions])
+        target_items = np.unique(target >> 32)
+
+        # Items without performer tags are left alone, so only their current tags count
+        current = (existing[:, 0] << 32) | existing[:, 1]
+        current = np.sort(current[np.isin(existing[:, 0], target_items)])
+
+        add = np.setdiff1d(target, current, assume_unique=True)
+        remove = np.setdiff1d(current, target, assume_unique=True) if tag_mode == "SET" else current[:0]
+        add_items, remove_items = add >> 32, remove >> 32
+        changed = np.union1d(add_items, remove_items)
+
+        add_bounds = np.searchsorted(add_items, changed, side="right")
+        remove_bounds = np.searchsorted(remove_items, changed, side="right")
+        add_tags = (add & 0xFFFFFFFF).tolist()
+        remove_tags = (remove & 0xFFFFFFFF).tolist()
+        changes = []
+        add_start = remove_start = 0
+        for item_id, add_end, remove_end in zip(changed.tolist(), add_bounds.tolist(), remove_bounds.tolist()):
+            changes.append((item_id, add_tags[add_start:add_end], remove_tags[remove_start:remove_end]))
+            add_start, remove_start = add_end, remove_end
+
+    return changes, len(target_items) - len(changed)
+
+
+def apply_changes(write_cursor, entity, changes, provenance=False, parent_tags=False, gallery_performers=False):
+    """Write the (item_id, tags_to_add, tags_to_remove) changes from diff_batch - returns rows written
+
+    With provenance, the added rows are recorded in the provenance ledger along with
+    the item's performers that carry each tag, and removed rows are dropped from it.
+    The changes may have been read outside the write transaction (or planned long
+    before), so the ledger and the change journal only get the rows that really changed.
+    """
+    id_column = entity["id_column"]
+    tags_table = entity["tags_table"]
+    delete_sql = f"DELETE FROM {tags_table} WHERE {id_column} = ? AND tag_id = ?"
+    insert_sql = f"INSERT OR IGNORE INTO {tags_table} ({id_column}, tag_id) VALUES (?, ?)"
+
+    removals = [(item_id, tag_id) for item_id, _, removed_tags in changes for tag_id in removed_tags]
+    additions = [(item_id, tag_id) for item_id, new_tags, _ in changes for tag_id in new_tags]
+    if not (provenance or journal.active):
+        rows = 0
+        if removals:
+            rows += write_cursor.executemany(delete_sql, removals).rowcount
+        if additions:
+            rows += write_cursor.executemany(insert_sql, additions).rowcount
+        return rows
+
+    # Each statement changes at most one row, so when the rowcounts cover every row they
+    # all changed. Otherwise someone else already added or removed some of them - redo the
+    # rows one at a time and keep those that changed, so they aren't journaled or claimed
+    # as derived
+    write_cursor.execute("SAVEPOINT pts_changes")
+    rows = 0
+    if removals:
+        rows += write_cursor.executemany(delete_sql, removals).rowcount
+    if additions:
+        rows += write_cursor.executemany(insert_sql, additions).rowcount
+    if rows != len(removals) + len(additions):
+        metrics.count("drifted_batches")
+        write_cursor.execute("ROLLBACK TO pts_changes")
+        removals = [row for row in removals if write_cursor.execute(delete_sql, row).rowcount]
+        additions = [row for row in additions if write_cursor.execute(insert_sql, row).rowcount]
+    write_cursor.execute("RELEASE pts_changes")
+    if journal.active:
+        written = {}
+        for item_id, tag_id in additions:
+            written.setdefault(item_id, ([], []))[0].append(tag_id)
+        for item_id, tag_id in removals:
+            written.setdefault(item_id, ([], []))[1].append(tag_id)
+        journal.record(entity["table"], [(item_id, added, removed) for item_id, (added, removed) in written.items()])
+
+    if provenance and (removals or additions):
+        write_cursor.execute(PROVENANCE_TABLE_SQL)
+        write_cursor.executemany("DELETE FROM pts_provenance WHERE entity = ? AND item_id = ? AND tag_id = ?",
+                                 ((entity["table"], item_id, tag_id) for item_id, tag_id in removals))
+        write_cursor.executemany(f"""
+            INSERT OR IGNORE INTO pts_provenance (entity, item_id, tag_id, performer_id)
+            SELECT ?, p.{id_column}, pt.tag_id, p.performer_id
+            FROM {item_performers_source(entity, gallery_performers)} p
+            CROSS JOIN {performer_tags_source(parent_tags)} pt ON pt.performer_id = p.performer_id
+            WHERE p.{id_column} = ? AND pt.tag_id = ?
+        """, ((entity["table"], item_id, tag_id) for item_id, tag_id in additions))
+    return len(removals) + len(additions)
+
+
+def sync_tags_python(read_cursor, write_cursor, entity, batch_ids, performer_tags, tag_mode, provenance=False,
+                     parent_tags=False, gallery_performers=False):
+    """Python engine: diff the batch's tags in Python and write only the differences
+
+    Returns (updated, rows, unchanged).
+    """
+    changes, unchanged = diff_batch(read_cursor, entity, batch_ids, performer_tags, tag_mode, gallery_performers)
+    rows = apply_changes(write_cursor, entity, changes, provenance, parent_tags, gallery_performers)
+    return len(changes), rows, unchanged
+
+
+def add_tags_sql(write_cursor, entity, provenance=False, parent_tags=False, gallery_performers=False):
+    """ADD mode, SQL engine: insert the whole batch's missing performer tags in one statement
+
+    Expects the batch loaded into temp.pts_batch on the write connection. With
+    provenance, the rows about to be added are first recorded in the provenance ledger
+    with the performers that imply them - tags an item already had are left out, so a
+    manual tag is never mistaken for a derived one.
+    """
+    id_column = entity["id_column"]
+    source = performer_tags_source(parent_tags)
+    links = batch_performers_sql(entity, gallery_performers)
+
+    if provenance:
+        write_cursor.execute(PROVENANCE_TABLE_SQL)
+        write_cursor.execute(f"""
+            INSERT OR IGNORE INTO pts_provenance (entity, item_id, tag_id, performer_id)
+            SELECT ?, p.{id_column}, pt.tag_id, p.performer_id
+            FROM {links} p
+            CROSS JOIN {source} pt ON pt.performer_id = p.performer_id
+            WHERE NOT EXISTS (
+                SELECT 1 FROM {entity['tags_table']} t WHERE t.{id_column} = p.{id_column} AND t.tag_id = pt.tag_id
+            )
+        """, (entity["table"],))
+
+    # The primary key on (item, tag) lets OR IGNORE skip tags the item already has,
+    # so rowcount is exactly the number of tag rows inserted - and RETURNING exactly
+    # those rows, for the change journal
+    insert_sql = f"""
+        INSERT OR IGNORE INTO {entity['tags_table']} ({id_column}, tag_id)
+        SELECT DISTINCT p.{id_column}, pt.tag_id
+        FROM {links} p
+        CROSS JOIN {source} pt ON pt.performer_id = p.performer_id
+    """
+    if not journal.active:
+        write_cursor.execute(insert_sql)
+        return write_cursor.rowcount
+
+    added = {}
+    for item_id, tag_id in write_cursor.execute(f"{insert_sql} RETURNING {id_column}, tag_id").fetchall():
+        added.setdefault(item_id, []).append(tag_id)
+    journal.record(entity["table"], [(item_id, tags, []) for item_id, tags in added.items()])
+    return sum(len(tags) for tags in added.values())
+
+
+def start_entity_sync(read_cursor, db_path, settings, exclusion_tag_ids, entity_key, performer_tags=None):
+    """Work out what a bulk sync of one entity type has to visit
+
+    Applies the filters, resume checkpoint and delta candidates, and counts the items.
+    Returns the job dict the batch functions below share. The delta candidates live in
+    a temp table, so the job's batches must be read on the same read_cursor.
+    """
+    entity = ENTITIES[entity_key]
+    label = entity["label"]
+    use_sql_engine = settings["tagMode"] == "ADD" and settings["engine"] == "SQL"
+    gallery_performers = inherits_gallery_performers(entity, settings["inheritGalleryPerformers"])
+    log.info(f"Starting {entity['singular']} sync...")
+
+    where_sql, params = build_filter_sql(read_cursor, entity, settings, exclusion_tag_ids)
+
+    # A checkpoint left by an interrupted run of the same mode says which items are
+    # already committed - the IDs are streamed in order, so we carry on after it
+    checkpoint_key = f"checkpoint:{entity_key}:{settings['tagMode']}"
+    checkpoint_settings = {key: settings.get(key) for key in CHECKPOINT_SETTINGS_KEYS}
+    checkpoint = load_state(read_cursor, checkpoint_key) if settings["resumeSync"] else None
+    if checkpoint and checkpoint["settings"] != checkpoint_settings:
+        log.info(f"Settings changed since the interrupted {entity['singular']} sync, starting over")
+        checkpoint = None
+
+    # Delta mode: take the new watermark before scanning so anything changed mid-run
+    # is picked up again next time, then restrict the scan to changed items. A resumed
+    # run keeps the watermark of the run it continues, which is when its scan began
+    new_watermark = None
+    if settings["deltaSync"]:
+        new_watermark = checkpoint["watermark"] if checkpoint else read_watermark(read_cursor, entity, settings)
+        watermark = load_state(read_cursor, f"watermark:{entity_key}")
+        if watermark and watermark["settings"] == new_watermark["settings"]:
+            with metrics.phase("id_scan"):
+                candidates = load_delta_candidates(read_cursor, entity, watermark, gallery_performers)
+            log.info(f"Delta sync: {candidates} {label} changed since the last run")
+            where_sql += f" AND {entity['alias']}.id IN (SELECT id FROM temp.pts_candidates)"
+        elif watermark:
+            log.info("Delta sync: settings changed since the last run, doing a full sync")
+        else:
+            log.info("Delta sync: no previous run recorded, doing a full sync")
+
+    # The SQL engine joins performers_tags inside SQLite, so the map is only needed in Python
+    if use_sql_engine:
+        performer_tags = {}
+    elif performer_tags is None:
+        performer_tags = get_performer_tags(read_cursor, db_path, settings["compactMaps"],
+                                            settings["includeParentTags"])
+        log.info(f"Found {len(performer_tags)} performers with tags")
+
+    # Count items with performers for progress reporting - the IDs themselves are streamed
+    log.info(f"Counting {label} with performers...")
+    total_items = count_items(read_cursor, entity, where_sql, params, gallery_performers)
+    log.info(f"Found {total_items} {label} to process")
+
+    stats = {"items": total_items, "updated": 0, "rows": 0, "unchanged": 0}
+    metrics.entities[entity_key] = stats
+    job = {
+        "entity_key": entity_key,
+        "entity": entity,
+        "use_sql_engine": use_sql_engine,
+        "where_sql": where_sql,
+        "params": params,
+        "performer_tags": performer_tags,
+        "provenance": settings["trackProvenance"],
+        "parent_tags": settings["includeParentTags"],
+        "gallery_performers": gallery_performers,
+        "checkpoint_key": checkpoint_key,
+        "checkpoint_settings": checkpoint_settings,
+        "checkpoint": checkpoint,
+        "watermark": new_watermark,
+        "total": total_items,
+        "processed": 0,
+        "after_id": 0,
+        "stats": stats,
+        "started": time.perf_counter(),
+    }
+    if checkpoint and total_items:
+        job["processed"], job["after_id"] = checkpoint["processed"], checkpoint["last_id"]
+        log.info(f"Resuming {entity['singular']} sync after {entity['singular']} {job['after_id']} "
+                 f"({job['processed']}/{total_items} already done)")
+    return job
+
+
+def read_job_batches(read_cursor, job, settings):
+    """Yield the job's batches in ID order, each diffed against the performer tags unless the
+    SQL engine will do that on the write connection
+
+    Each batch is a dict with the item "ids", "start" (items done before it) and, for the
+    Python engine, the "changes" from diff_batch and the "unchanged" count.
+    """
+    processed = job["processed"]
+    for batch_ids in iter_item_batches(read_cursor, job["entity"], job["where_sql"], job["params"],
+                                       settings["batchSize"], job["after_id"], job["gallery_performers"]):
+        batch = {"ids": batch_ids, "start": processed}
+        processed += len(batch_ids)
+        if not job["use_sql_engine"]:
+            # SET mode, or ADD mode with the Python engine: diff in Python on the read connection
+            with metrics.phase("read"):
+                load_batch(read_cursor, batch_ids)
+            batch["changes"], batch["unchanged"] = diff_batch(
+                read_cursor, job["entity"], batch_ids, job["performer_tags"], settings["tagMode"],
+                job["gallery_performers"])
+        yield batch
+
+
+def write_job_batch(write_conn, job, budget, batch):
+    """Write one batch from read_job_batches, checkpointing in every transaction"""
+    entity = job["entity"]
+    write_cursor = write_conn.cursor()
+    batch_ids = batch["ids"]
+    stats = job["stats"]
+    job["processed"] = batch["start"] + len(batch_ids)
+    log.info(f"Processing {entity['label']} {batch['start']+1}-{job['processed']}/{job['total']}")
+
+    def save_checkpoint(last_unit):
+        # Everything up to the chunk's last item is committed with this transaction; the
+        # final chunk of a batch also covers the batch's trailing unchanged items
+        if last_unit is None:
+            last_id = batch_ids[-1]
+        else:
+            last_id = last_unit if job["use_sql_engine"] else last_unit[0]
+        save_state(write_cursor, job["checkpoint_key"], {
+            "settings": job["checkpoint_settings"],
+            "last_id": last_id,
+            "processed": batch["start"] + bisect_right(batch_ids, last_id),
+            "watermark": job["watermark"],
+        })
+
+    def add_chunk(chunk):
+        load_batch(write_cursor, chunk)
+        return add_tags_sql(write_cursor, entity, job["provenance"], job["parent_tags"], job["gallery_performers"])
+
+    metrics.count("batches")
+    if job["use_sql_engine"]:
+        # ADD mode, SQL engine: one INSERT ... SELECT per transaction, joined on the write connection
+        rows = write_budgeted(write_conn, budget, batch_ids, add_chunk, save_checkpoint)
+    else:
+        # Write only the differences. A batch with nothing to write doesn't move the
+        # checkpoint - redoing it after a crash is read-only
+        rows = write_budgeted(write_conn, budget, batch["changes"],
+                              partial(apply_changes, write_cursor, entity, provenance=job["provenance"],
+                                      parent_tags=job["parent_tags"], gallery_performers=job["gallery_performers"]),
+                              save_checkpoint)
+        stats["updated"] += len(batch["changes"])
+        stats["unchanged"] += batch["unchanged"]
+    stats["rows"] += rows
+    metrics.count("rows_written", rows)
+    if job["use_sql_engine"]:
+        log.info(f"Added {stats['rows']} {entity['singular']} tags so far")
+    else:
+        log.info(f"Updated {stats['updated']} {entity['label']} so far")
+
+
+def finish_job(write_conn, job):
+    """Clear the checkpoint and advance the watermark once every batch has been written"""
+    entity = job["entity"]
+    stats = job["stats"]
+    if job["total"] or job["checkpoint"] or job["watermark"]:
+        finish_sync_state(write_conn, job["entity_key"], job["checkpoint_key"], job["watermark"])
+
+    stats["seconds"] = round(time.perf_counter() - job["started"], 4)
+    if not job["total"]:
+        log.info(f"No {entity['label']} to process")
+    elif job["use_sql_engine"]:
+        log.info(f"{entity['singular'].capitalize()} sync complete - added {stats['rows']} tags")
+    else:
+        log.info(f"{entity['singular'].capitalize()} sync complete - updated {stats['updated']} {entity['label']}, "
+                 f"{stats['unchanged']} unchanged")
+    return stats
+
+
+def sync_entity(db_path, settings, exclusion_tag_ids, entity_key, snapshot=None):
+    """Sync performer tags to one entity type (images, galleries or scenes) using direct SQL
+
+    With a ReadSnapshot, items are paged and diffed against the snapshot and only the
+    writes go to the database.
+    """
+    # Use read-only connection for reading data
+    read_conn = open_read_connection(db_path, snapshot)
+    read_cursor = read_conn.cursor()
+    job = start_entity_sync(read_cursor, db_path, settings, exclusion_tag_ids, entity_key)
+
+    # Process in batches - now create write connection
+    write_conn = create_write_connection(db_path)
+
+    # Reads page through batchSize items at a time, but writes are split into
+    # transactions sized to hold the write lock for about writeBudgetMs
+    budget = WriteBudget(settings["writeBudgetMs"] / 1000, settings["batchSize"])
+    if job["total"]:
+        for batch in read_job_batches(read_cursor, job, settings):
+            log.progress(0.1 + (0.9 * min(batch["start"] + len(batch["ids"]), job["total"]) / job["total"]))
+            write_job_batch(write_conn, job, budget, batch)
+
+    stats = finish_job(write_conn, job)
+    read_conn.close()
+    write_conn.close()
+    return stats
+
+
+def read_entity_pipeline(db_path, settings, exclusion_tag_ids, entity_key, performer_tags, batches, stop,
+                         snapshot=None):
+    """Reader thread for sync_pipelined: read and diff one entity type on its own read-only connection
+
+    Puts ("start", job), then ("batch", job, batch) for every batch and ("done", job) on
+    the batches queue, or ("error", job, exception) if it fails. Blocks while the queue
+    is full, and gives up once stop is set.
+    """
+    import queue
+
+    def put(message):
+        while not stop.is_set():
+            try:
+                batches.put(message, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    job = None
+    read_conn = open_read_connection(db_path, snapshot)
+    try:
+        read_cursor = read_conn.cursor()
+        job = start_entity_sync(read_cursor, db_path, settings, exclusion_tag_ids, entity_key, performer_tags)
+        if not put(("start", job)):
+            return
+        if job["total"]:
+            for batch in read_job_batches(read_cursor, job, settings):
+                if not put(("batch", job, batch)):
+                    return
+        put(("done", job))
+    except Exception as e:
+        put(("error", job, e))
+    finally:
+        read_conn.close()
+
+
+def sync_pipelined(db_path, settings, exclusion_tag_ids, entity_keys, snapshot=None):
+    """Sync several entity types at once: one reader thread per type, one writer
+
+    Each reader thread counts, pages and diffs its type on its own read-only connection
+    (WAL lets them read alongside the writer) and hands finished batches to this thread
+    through a bounded queue. This thread is the only writer, so reading and computing
+    overlap with writing and the run takes about as long as its slowest stage. With a
+    ReadSnapshot, every reader connects to it. Returns the stats per entity key.
+    """
+    import queue
+    import threading
+
+    # Build the performer tag map once for every reader instead of once per thread
+    performer_tags = None
+    if settings["tagMode"] == "SET" or settings["engine"] == "PYTHON":
+        read_conn = open_read_connection(db_path, snapshot)
+        performer_tags = get_performer_tags(read_conn.cursor(), db_path, settings["compactMaps"],
+                                            settings["includeParentTags"])
+        read_conn.close()
+        log.info(f"Found {len(performer_tags)} performers with tags")
+
+    batches = queue.Queue(maxsize=PIPELINE_QUEUE_BATCHES)
+    stop = threading.Event()
+    readers = [
+        threading.Thread(target=read_entity_pipeline, name=f"pts-read-{entity_key}", daemon=True,
+                         args=(db_path, settings, exclusion_tag_ids, entity_key, performer_tags, batches, stop,
+                               snapshot))
+        for entity_key in entity_keys
+    ]
+    for reader in readers:
+        reader.start()
+
+    write_conn = create_write_connection(db_path)
+    jobs = {}
+    budgets = {}
+    results = {}
+    try:
+        while len(results) < len(readers):
+            message = batches.get()
+            kind, job = message[0], message[1]
+            if kind == "error":
+                raise message[2]
+            if kind == "start":
+                jobs[job["entity_key"]] = job
+                budgets[job["entity_key"]] = WriteBudget(settings["writeBudgetMs"] / 1000, settings["batchSize"])
+            elif kind == "batch":
+                write_job_batch(write_conn, job, budgets[job["entity_key"]], message[2])
+                total = sum(known["total"] for known in jobs.values())
+                if total:
+                    done = sum(known["processed"] for known in jobs.values())
+                    log.progress(0.1 + (0.9 * min(done, total) / total))
+            else:
+                results[job["entity_key"]] = finish_job(write_conn, job)
+    finally:
+        stop.set()
+        for reader in readers:
+            reader.join()
+        write_conn.close()
+    return results
+
+
+def sync_batch(conn, settings, exclusion_tag_ids, entity_key, item_ids, performer_tags=None):
+    """Sync an explicit list of items on one write connection (caller commits)
+
+    Only reads the rows belonging to those items, so it costs a handful of indexed
+    lookups per item regardless of library size. Without a performer_tags map, the
+    Python paths look up just these items' performer tags.
+    """
+    entity = ENTITIES[entity_key]
+    alias = entity["alias"]
+    gallery_performers = inherits_gallery_performers(entity, settings["inheritGalleryPerformers"])
+    cursor = conn.cursor()
+    where_sql, params = build_filter_sql(cursor, entity, settings, exclusion_tag_ids)
+
+    # Drop items that were deleted or are excluded
+    load_batch(cursor, item_ids)
+    cursor.execute(f"""
+        SELECT {alias}.id
+        FROM temp.pts_batch b
+        CROSS JOIN {entity['table']} {alias} ON {alias}.id = b.id {where_sql}
+        ORDER BY {alias}.id
+    """, params)
+    batch_ids = [row[0] for row in cursor.fetchall()]
+    if not batch_ids:
+        return {"items": 0, "updated": 0, "rows": 0, "unchanged": 0}
+    if len(batch_ids) < len(item_ids):
+        load_batch(cursor, batch_ids)
+
+    if settings["tagMode"] == "ADD" and settings["engine"] == "SQL":
+        updated, rows, unchanged = 0, add_tags_sql(
+            cursor, entity, settings["trackProvenance"], settings["includeParentTags"], gallery_performers), 0
+    else:
+        if performer_tags is None:
+            performer_tags = load_item_performer_tags(cursor, entity, settings["includeParentTags"],
+                                                      gallery_performers)
+        updated, rows, unchanged = sync_tags_python(
+            conn.cursor(), cursor, entity, batch_ids, performer_tags, settings["tagMode"],
+            settings["trackProvenance"], settings["includeParentTags"], gallery_performers)
+
+    return {"items": len(batch_ids), "updated": updated, "rows": rows, "unchanged": unchanged}
+
+
+def sync_item(db_path, settings, exclusion_tag_ids, entity_key, item_id):
+    """Sync performer tags to a single item - the low-latency path used by hooks"""
+    conn = create_write_connection(db_path)
+    stats = sync_batch(conn, settings, exclusion_tag_ids, entity_key, [item_id])
+    conn.commit()
+    conn.close()
+    if not stats["items"]:
+        log.debug(f"{ENTITIES[entity_key]['singular'].capitalize()} {item_id} not found or excluded, skipping")
+    return stats
+
+
+def load_performer_items(cursor, entity, performer_ids, gallery_performers=False):
+    """Return the sorted IDs of the items any of the given performers appear in"""
+    source = item_performers_source(entity, gallery_performers)
+    item_ids = set()
+    for perf_id in performer_ids:
+        cursor.execute(f"SELECT {entity['id_column']} FROM {source} WHERE performer_id = ?", (perf_id,))
+        item_ids.update(row[0] for row in cursor)
+    return sorted(item_ids)
+
+
+def sync_items(conn, settings, exclusion_tag_ids, entity_key, item_ids):
+    """Sync a list of items of one entity type, batchSize items per write transaction
+
+    Returns the summed sync_batch stats.
+    """
+    batch_size = settings["batchSize"]
+    stats = {"items": 0, "updated": 0, "rows": 0, "unchanged": 0}
+    for start in range(0, len(item_ids), batch_size):
+        if start:
+            time.sleep(WRITE_YIELD_SECONDS)
+        batch_stats, _ = run_write_transaction(conn, partial(
+            sync_batch, conn, settings, exclusion_tag_ids, entity_key, item_ids[start:start + batch_size]))
+        metrics.count("batches")
+        for key in stats:
+            stats[key] += batch_stats[key]
+    metrics.count("rows_written", stats["rows"])
+    return stats
+
+
+def sync_performers(db_path, settings, exclusion_tag_ids, performer_ids):
+    """Fan out a change to some performers' tags: sync only the items they appear in
+
+    An item's current tags are the performer tags it was last synced with, so diffing
+    just these items applies the tags that were added (and in SET mode removed) and
+    leaves the rest of the library alone - a performer with a few thousand scenes
+    takes milliseconds instead of a full scan. Writes batchSize items per transaction.
+    Returns the stats per entity key.
+    """
+    conn = create_write_connection(db_path)
+    cursor = conn.cursor()
+    results = {}
+    for entity_key, entity in ENTITIES.items():
+        if not settings[ENTITY_SETTINGS[entity_key]]:
+            continue
+        with metrics.phase("id_scan"):
+            item_ids = load_performer_items(cursor, entity, performer_ids, settings["inheritGalleryPerformers"])
+
+        stats = sync_items(conn, settings, exclusion_tag_ids, entity_key, item_ids)
+        metrics.entities[entity_key] = stats
+        results[entity_key] = stats
+        log.info(f"Synced {stats['items']} {entity['label']} of {len(performer_ids)} performers "
+                 f"({stats['rows']} tag rows written)")
+    conn.close()
+    return results
+
+
+def run_performer_sync(db_path, settings, performer_ids):
+    """Task entry point for sync_performers"""
+    if not performer_ids:
+        raise ValueError("performerIds is required for the performers task")
+    with metrics.phase("schema_check"):
+        check_schema_version(db_path)
+    with metrics.phase("settings"):
+        exclusion_tag_ids = get_exclusion_tag_ids(db_path, settings)
+    ensure_tag_closure(db_path, settings)
+
+    log.info(f"Syncing the items of performers {', '.join(map(str, performer_ids))}...")
+    sync_performers(db_path, settings, exclusion_tag_ids, performer_ids)
+    log.progress(1.0)
+
+
+def parse_id_list(value):
+    """Read a list of IDs given as a JSON list or a comma-separated string"""
+    if isinstance(value, str):
+        value = value.split(",")
+    return [int(item) for item in value or [] if str(item).strip()]
+
+
+def enqueue_item(conn, entity_key, item_id):
+    """Add an item to the hook queue (caller commits)
+
+    Re-queuing an item that is already waiting replaces its row with a newer seq, so a
+    drain that read the old row won't delete the new request.
+    """
+    conn.execute(QUEUE_TABLE_SQL)
+    conn.execute("INSERT OR REPLACE INTO pts_queue (entity, item_id) VALUES (?, ?)", (entity_key, item_id))
+
+
+def enqueue_performer_items(conn, entity_key, perf_id, gallery_performers=False):
+    """Add every item a performer appears in to the hook queue (caller commits)"""
+    entity = ENTITIES[entity_key]
+    conn.execute(QUEUE_TABLE_SQL)
+    conn.execute(f"""
+        INSERT OR REPLACE INTO pts_queue (entity, item_id)
+        SELECT ?, {entity['id_column']} FROM {item_performers_source(entity, gallery_performers)} WHERE performer_id = ?
+    """, (entity_key, perf_id))
+
+
+def enqueue_gallery_images(conn, gallery_id):
+    """Add every image in a gallery to the hook queue (caller commits)"""
+    conn.execute(QUEUE_TABLE_SQL)
+    conn.execute("""
+        INSERT OR REPLACE INTO pts_queue (entity, item_id)
+        SELECT 'images', image_id FROM galleries_images WHERE gallery_id = ?
+    """, (gallery_id,))
+
+
+def acquire_drain_lease(conn, owner):
+    """Try to become the single queue drainer (caller commits) - returns True on success"""
+    conn.execute(DRAINER_TABLE_SQL)
+    now = time.time()
+    # Take over a lease left behind by a drainer that died
+    conn.execute("DELETE FROM pts_drainer WHERE expires < ?", (now,))
+    cursor = conn.execute(
+        "INSERT OR IGNORE INTO pts_drainer (id, owner, expires) VALUES (1, ?, ?)",
+        (owner, now + DRAIN_LEASE_SECONDS)
+    )
+    return cursor.rowcount == 1
+
+
+def release_drain_lease(conn, owner):
+    """Give up the drainer lease"""
+    conn.execute("DELETE FROM pts_drainer WHERE owner = ?", (owner,))
+    conn.commit()
+
+
+def drain_pass(conn, db_path, settings, exclusion_tag_ids, owner):
+    """Sync up to batchSize queued items and remove them from the queue (caller commits)
+
+    Returns the number of items drained, 0 once the queue is empty.
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT seq, entity, item_id FROM pts_queue ORDER BY seq LIMIT ?", (settings["batchSize"],))
+    queued = cursor.fetchall()
+    if not queued:
+        return 0
+
+    # Only the Python paths need the map - it is shared across passes while unchanged
+    performer_tags = None
+    if settings["tagMode"] == "SET" or settings["engine"] == "PYTHON":
+        performer_tags = get_performer_tags(cursor, db_path, settings["compactMaps"], settings["includeParentTags"])
+
+    items = {}
+    for _, entity_key, item_id in queued:
+        items.setdefault(entity_key, []).append(item_id)
+    for entity_key, item_ids in items.items():
+        sync_batch(conn, settings, exclusion_tag_ids, entity_key, item_ids, performer_tags)
+
+    cursor.execute("DELETE FROM pts_queue WHERE seq <= ?", (queued[-1][0],))
+    cursor.execute("UPDATE pts_drainer SET expires = ? WHERE owner = ?", (time.time() + DRAIN_LEASE_SECONDS, owner))
+    return len(queued)
+
+
+def drain_queue(conn, db_path, settings, exclusion_tag_ids, owner):
+    """Process queued hook items until the queue is empty (caller holds the drainer lease)
+
+    Each pass takes up to batchSize queued items, syncs them per entity type and removes
+    them from the queue in one transaction, retried if the database is busy. Items queued
+    while a pass runs are picked up by the next pass instead of starting a competing writer.
+    """
+    cursor = conn.cursor()
+    total = 0
+    while True:
+        try:
+            while True:
+                drained, _ = run_write_transaction(
+                    conn, partial(drain_pass, conn, db_path, settings, exclusion_tag_ids, owner))
+                if not drained:
+                    break
+                total += drained
+        finally:
+            conn.rollback()
+            release_drain_lease(conn, owner)
+
+        # An item queued between the last empty check and the release saw the lease
+        # still taken and left it for us, so look once more before exiting
+        cursor.execute("SELECT 1 FROM pts_queue LIMIT 1")
+        if cursor.fetchone() is None or not acquire_drain_lease(conn, owner):
+            conn.commit()
+            return total
+        conn.commit()
+
+
+def sync_images(db_path, settings, exclusion_tag_ids):
+    """Sync performer tags to images using direct SQL"""
+    return sync_entity(db_path, settings, exclusion_tag_ids, "images")
+
+
+def sync_galleries(db_path, settings, exclusion_tag_ids):
+    """Sync performer tags to galleries using direct SQL"""
+    return sync_entity(db_path, settings, exclusion_tag_ids, "galleries")
+
+
+def sync_scenes(db_path, settings, exclusion_tag_ids):
+    """Sync performer tags to scenes using direct SQL"""
+    return sync_entity(db_path, settings, exclusion_tag_ids, "scenes")
+
+
+def plan_entity(db_path, settings, exclusion_tag_ids, entity_key, performer_tags, plan_file, snapshot=None):
+    """Compute the changes a sync would make to one entity type and stream them to plan_file
+
+    Uses only a read-only connection, so it takes no write lock however long it runs.
+    Each item that would change becomes one NDJSON line; returns the per-entity totals.
+    """
+    entity = ENTITIES[entity_key]
+    label = entity["label"]
+    log.info(f"Planning {entity['singular']} sync...")
+
+    read_conn = open_read_connection(db_path, snapshot)
+    read_cursor = read_conn.cursor()
+    gallery_performers = inherits_gallery_performers(entity, settings["inheritGalleryPerformers"])
+    where_sql, params = build_filter_sql(read_cursor, entity, settings, exclusion_tag_ids)
+    total_items = count_items(read_cursor, entity, where_sql, params, gallery_performers)
+
+    summary = {"type": "summary", "entity": entity_key, "items": total_items,
+               "updated": 0, "unchanged": 0, "add_rows": 0, "remove_rows": 0}
+    processed = 0
+    for batch_ids in iter_item_batches(read_cursor, entity, where_sql, params, settings["batchSize"],
+                                       gallery_performers=gallery_performers):
+        processed += len(batch_ids)
+        log.progress(min(processed, total_items) / total_items)
+
+        with metrics.phase("read"):
+            load_batch(read_cursor, batch_ids)
+        changes, unchanged = diff_batch(read_cursor, entity, batch_ids, performer_tags, settings["tagMode"],
+                                        gallery_performers)
+        for item_id, new_tags, removed_tags in changes:
+            plan_file.write(json.dumps(
+                {"e": entity_key, "id": item_id, "add": sorted(new_tags), "remove": sorted(removed_tags)},
+                separators=(",", ":")) + "\n")
+            summary["add_rows"] += len(new_tags)
+            summary["remove_rows"] += len(removed_tags)
+        summary["updated"] += len(changes)
+        summary["unchanged"] += unchanged
+
+    read_conn.close()
+    metrics.entities[entity_key] = summary
+    log.info(f"Plan for {label}: {summary['updated']} of {total_items} would change "
+             f"(+{summary['add_rows']} / -{summary['remove_rows']} tag rows), {summary['unchanged']} unchanged")
+    return summary
+
+
+def write_plan(db_path, settings, entity_keys, plan_path):
+    """Dry run: write the full change plan for the enabled entity types without touching the database
+
+    The plan is gzipped NDJSON: a header line, one line per item that would change, and
+    a summary line per entity type.
+    """
+    with metrics.phase("schema_check"):
+        check_schema_version(db_path)
+    with metrics.phase("settings"):
+        exclusion_tag_ids = get_exclusion_tag_ids(db_path, settings)
+    enabled_keys = [entity_key for entity_key in entity_keys if settings[ENTITY_SETTINGS[entity_key]]]
+    snapshot = ReadSnapshot(db_path, settings, enabled_keys) if settings["snapshotReads"] else None
+
+    read_conn = open_read_connection(db_path, snapshot)
+    read_cursor = read_conn.cursor()
+    # Only the performer tag map reads the closure, so a stale one is rebuilt on this connection alone
+    use_temp_tag_closure(read_cursor, settings)
+    performer_tags = get_performer_tags(read_cursor, db_path, settings["compactMaps"], settings["includeParentTags"])
+    header = {
+        "type": "header",
+        "version": PLAN_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "database": os.path.abspath(db_path),
+        "tagMode": settings["tagMode"],
+        "performer_tags_fingerprint": performer_tags_fingerprint(read_cursor),
+    }
+    read_conn.close()
+
+    # Write to a temp file and rename so an interrupted plan never looks complete
+    tmp_path = f"{plan_path}.tmp"
+    summaries = []
+    try:
+        import gzip
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as plan_file:
+            plan_file.write(json.dumps(header) + "\n")
+            for entity_key in enabled_keys:
+                summaries.append(plan_entity(db_path, settings, exclusion_tag_ids, entity_key,
+                                             performer_tags, plan_file, snapshot))
+            for summary in summaries:
+                plan_file.write(json.dumps(summary) + "\n")
+    finally:
+        if snapshot:
+            snapshot.close()
+    os.replace(tmp_path, plan_path)
+
+    log.info(f"Plan written to {plan_path}")
+    log.progress(1.0)
+    return summaries
+
+
+def apply_plan(db_path, settings, plan_path):
+    """Replay a plan written by write_plan, batchSize items per transaction"""
+    import gzip
+    with gzip.open(plan_path, "rt", encoding="utf-8") as plan_file:
+        header = json.loads(plan_file.readline())
+        if header.get("type") != "header" or header.get("version") != PLAN_VERSION:
+            raise ValueError(f"{plan_path} is not a version {PLAN_VERSION} sync plan")
+        if header["database"] != os.path.abspath(db_path):
+            log.warning(f"Plan was computed for {header['database']}, applying to {db_path}")
+
+        ensure_tag_closure(db_path, settings)
+        write_conn = create_write_connection(db_path)
+        write_cursor = write_conn.cursor()
+        if performer_tags_fingerprint(write_cursor) != header["performer_tags_fingerprint"]:
+            log.warning("Performer tags changed since the plan was computed - applying it as planned anyway")
+
+        log.info(f"Applying {header['tagMode']} plan created {header['created']}...")
+        applied = write_change_records(write_conn, settings, plan_file, partial(
+            apply_changes, write_cursor, provenance=settings["trackProvenance"],
+            parent_tags=settings["includeParentTags"], gallery_performers=settings["inheritGalleryPerformers"]))
+        write_conn.close()
+
+    log.info(f"Plan applied - {applied['rows']} tag rows written across {applied['items']} items")
+    log.progress(1.0)
+    return applied
+
+
+def write_change_records(write_conn, settings, lines, write_changes):
+    """Write plan or journal lines, batchSize items at a time - returns {"items", "rows"}
+
+    write_changes(entity, changes) writes one entity type's (item_id, add, remove)
+    changes inside a budgeted write transaction. Header and summary lines are skipped.
+    """
+    pending = {}
+    applied = {"items": 0, "rows": 0}
+    budget = WriteBudget(settings["writeBudgetMs"] / 1000, settings["batchSize"])
+
+    def flush():
+        for entity_key, changes in pending.items():
+            rows = write_budgeted(write_conn, budget, changes, partial(write_changes, ENTITIES[entity_key]))
+            applied["rows"] += rows
+            metrics.count("rows_written", rows)
+        metrics.count("batches")
+        pending.clear()
+
+    pending_items = 0
+    for line in lines:
+        record = json.loads(line)
+        if "type" in record:
+            continue
+        pending.setdefault(record["e"], []).append((record["id"], record["add"], record["remove"]))
+        pending_items += 1
+        applied["items"] += 1
+        if pending_items >= settings["batchSize"]:
+            flush()
+            pending_items = 0
+            log.info(f"Applied changes to {applied['items']} items so far")
+    flush()
+    return applied
+
+
+def journal_dir(db_path):
+    return f"{db_path}.pts-journal"
+
+
+def list_journals(directory):
+    """Names of the journals in directory, oldest first by their sequence number"""
+    if not os.path.isdir(directory):
+        return []
+    return sorted((name for name in os.listdir(directory) if name.split("-", 1)[0].isdigit()),
+                  key=lambda name: int(name.split("-", 1)[0]))
+
+
+def start_journal(db_path, settings, task, keep=None):
+    """Open the change journal for a task, deleting all but the newest JOURNAL_KEEP journals
+
+    keep names a journal that is never deleted - the one a rollback is about to read.
+    """
+    if settings["engine"] == "SQL" and sqlite3.sqlite_version_info < (3, 35, 0):
+        # The SQL engine journals its inserts with RETURNING
+        log.info(f"SQLite {sqlite3.sqlite_version} can't journal the SQL engine, using the Python engine")
+        settings["engine"] = "PYTHON"
+    directory = journal_dir(db_path)
+    os.makedirs(directory, exist_ok=True)
+    journals = list_journals(directory)
+    for old in journals[:-(JOURNAL_KEEP - 1) or None]:
+        path = os.path.join(directory, old)
+        if not keep or not os.path.samefile(path, keep):
+            os.remove(path)
+
+    # Names start with a sequence number, so the order holds for tasks started in the same second
+    sequence = int(journals[-1].split("-", 1)[0]) + 1 if journals else 1
+    header = {
+        "type": "header",
+        "version": JOURNAL_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "database": os.path.abspath(db_path),
+        "task": task,
+        "tagMode": settings["tagMode"],
+    }
+    while True:
+        path = os.path.join(directory, f"{sequence:06d}-{time.strftime('%Y%m%d-%H%M%S')}-{task}.ndjson.gz")
+        try:
+            journal.open(path, header)
+            return
+        except FileExistsError:
+            # Another task took this number first
+            sequence += 1
+
+
+def latest_journal(db_path):
+    """Path of the newest change journal of the database, or None"""
+    directory = journal_dir(db_path)
+    journals = list_journals(directory)
+    return os.path.join(directory, journals[-1]) if journals else None
+
+
+def read_journal_lines(journal_file, journal_path):
+    """Yield a journal's lines, stopping quietly where an interrupted task's journal ends"""
+    import zlib
+    try:
+        yield from journal_file
+    except (EOFError, zlib.error):
+        log.warning(f"{journal_path} ends mid-write - the task that wrote it was interrupted, "
+                    f"undoing what it committed")
+
+
+def revert_changes(write_cursor, prune_ledger, entity, changes):
+    """Undo journaled (item_id, added, removed) changes: delete the added rows, restore the removed ones"""
+    rows = apply_changes(write_cursor, entity, [(item_id, removed, added) for item_id, added, removed in changes])
+    if prune_ledger:
+        write_cursor.executemany(
+            "DELETE FROM pts_provenance WHERE entity = ? AND item_id = ? AND tag_id = ?",
+            ((entity["table"], item_id, tag_id) for item_id, added, _ in changes for tag_id in added))
+    return rows
+
+
+def rollback_journal(db_path, settings, journal_path):
+    """Undo the tag changes recorded in a change journal, batchSize items per transaction
+
+    Rows the task added are deleted and rows it removed are inserted again, with the
+    same budgeted bulk writes a sync uses. A task writes each (item, tag) row at most
+    once, so the entries can be undone in any order and the journal is streamed from
+    the front. Provenance entries of deleted rows are dropped, but restored rows are not
+    recorded as derived, since a tag SET mode removed may have been a manual one.
+    """
+    if not journal_path:
+        raise ValueError("No change journal to roll back - enable Journal Changes before the run to undo")
+    import gzip
+    with gzip.open(journal_path, "rt", encoding="utf-8") as journal_file:
+        header = json.loads(journal_file.readline())
+        if header.get("type") != "header" or header.get("version") != JOURNAL_VERSION:
+            raise ValueError(f"{journal_path} is not a version {JOURNAL_VERSION} change journal")
+        if header["database"] != os.path.abspath(db_path):
+            log.warning(f"Journal was written for {header['database']}, rolling back on {db_path}")
+
+        write_conn = create_write_connection(db_path)
+        write_cursor = write_conn.cursor()
+        write_cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'pts_provenance'")
+        prune_ledger = write_cursor.fetchone() is not None
+
+        log.info(f"Rolling back the {header['task']} task of {header['created']}...")
+        reverted = write_change_records(write_conn, settings, read_journal_lines(journal_file, journal_path),
+                                        partial(revert_changes, write_cursor, prune_ledger))
+        write_conn.close()
+
+    log.info(f"Rolled back {reverted['rows']} tag rows across {reverted['items']} items")
+    log.progress(1.0)
+    return reverted
+
+
+def run_performer_hook(db_path, settings, hook_context):
+    """Handle Performer.Update.Post by syncing the items of the performer whose tags changed"""
+    hook_type = hook_context.get("type", "")
+    input_fields = hook_context.get("inputFields")
+    if input_fields is not None and "tag_ids" not in input_fields:
+        log.debug(f"{hook_type}: performer tags unchanged, skipping")
+        return
+
+    entity_keys = [entity_key for entity_key in ENTITIES if settings[ENTITY_SETTINGS[entity_key]]]
+    if not entity_keys:
+        log.debug(f"{hook_type}: sync disabled for every type, skipping")
+        return
+
+    perf_id = int(hook_context["id"])
+    exclusion_tag_ids = get_exclusion_tag_ids(db_path, settings)
+    ensure_tag_closure(db_path, settings)
+    if not settings["coalesceHooks"]:
+        results = sync_performers(db_path, settings, exclusion_tag_ids, [perf_id])
+        log.info(f"{hook_type}: synced the items of performer {perf_id} "
+                 f"({sum(stats['rows'] for stats in results.values())} tag rows written)")
+        return
+
+    # Queue the performer's items alongside any item hooks, and drain unless another
+    # hook process already is - bulk-editing performers then coalesces into batches
+    conn = create_write_connection(db_path)
+    owner = f"{os.getpid()}:{time.time()}"
+
+    def enqueue():
+        for entity_key in entity_keys:
+            enqueue_performer_items(conn, entity_key, perf_id, settings["inheritGalleryPerformers"])
+        return acquire_drain_lease(conn, owner)
+
+    is_drainer, _ = run_write_transaction(conn, enqueue)
+    if is_drainer:
+        drained = drain_queue(conn, db_path, settings, exclusion_tag_ids, owner)
+        log.info(f"{hook_type}: drained {drained} queued items")
+    else:
+        log.debug(f"{hook_type}: queued the items of performer {perf_id} for the active drainer")
+    conn.close()
+
+
+def implied_tag_sql(entity, settings, item, tag):
+    """EXISTS clause: some current performer of the item carries the tag"""
+    return f"""
+        EXISTS (
+            SELECT 1 FROM {item_performers_source(entity, settings["inheritGalleryPerformers"])} p
+            CROSS JOIN {performer_tags_source(settings["includeParentTags"])} pt
+                ON pt.performer_id = p.performer_id AND pt.tag_id = {tag}
+            WHERE p.{entity['id_column']} = {item}
+        )
+    """
+
+
+def stale_tags_sql(entity, settings, where_sql):
+    """Query for the provenance ledger's stale (item, tag) rows of one entity type
+
+    Binds the entity's table name, then the params of where_sql.
+    """
+    alias = entity["alias"]
+    id_column = entity["id_column"]
+    return f"""
+        SELECT DISTINCT l.item_id, l.tag_id
+        FROM pts_provenance l
+        LEFT JOIN {entity['table']} {alias} ON {alias}.id = l.item_id
+        WHERE l.entity = ? AND (
+            {alias}.id IS NULL
+            OR NOT EXISTS (SELECT 1 FROM {entity['tags_table']} t WHERE t.{id_column} = l.item_id AND t.tag_id = l.tag_id)
+            OR (NOT {implied_tag_sql(entity, settings, "l.item_id", "l.tag_id")} {where_sql})
+        )
+    """
+
+
+def retract_tags_sql(entity, settings):
+    """The two statements retracting a stale (item, tag) row
+
+    The first deletes the tag row unless a performer implies it again (binds item, tag).
+    The second prunes the ledger once the tag row is gone (binds entity table, item, tag).
+    """
+    id_column = entity["id_column"]
+    tags_table = entity["tags_table"]
+    delete_sql = f"""
+        DELETE FROM {tags_table}
+        WHERE {id_column} = ?1 AND tag_id = ?2 AND NOT {implied_tag_sql(entity, settings, "?1", "?2")}
+    """
+    prune_sql = f"""
+        DELETE FROM pts_provenance
+        WHERE entity = ?1 AND item_id = ?2 AND tag_id = ?3
+          AND NOT EXISTS (SELECT 1 FROM {tags_table} t WHERE t.{id_column} = ?2 AND t.tag_id = ?3)
+    """
+    return delete_sql, prune_sql
+
+
+def cleanup_entity(db_path, settings, exclusion_tag_ids, entity_key):
+    """Retract the derived tags of one entity type that no performer of the item implies any more
+
+    Only (item, tag) rows in the provenance ledger are candidates, so tags users added by
+    hand are never touched, and checking one costs two indexed probes: the item's
+    performers, then those performers' tags. Ledger rows whose tag is already gone
+    (removed by hand, or the item deleted) are dropped as well. Returns the number of
+    tag rows removed.
+    """
+    entity = ENTITIES[entity_key]
+
+    read_conn = create_read_connection(db_path)
+    read_cursor = read_conn.cursor()
+    where_sql, params = build_filter_sql(read_cursor, entity, settings, exclusion_tag_ids)
+    log.info(f"Checking derived {entity['singular']} tags...")
+    try:
+        with metrics.phase("id_scan"):
+            read_cursor.execute(stale_tags_sql(entity, settings, where_sql), [entity["table"]] + params)
+            stale = read_cursor.fetchall()
+    except sqlite3.OperationalError as e:
+        if "no such table" not in str(e):
+            raise
+        stale = []
+    finally:
+        read_conn.close()
+    metrics.count("rows_read", len(stale))
+
+    if not stale:
+        log.info(f"No stale derived {entity['singular']} tags")
+        return 0
+
+    # Check again under the write lock, in case a performer was linked since the read
+    write_conn = create_write_connection(db_path)
+    write_cursor = write_conn.cursor()
+    delete_sql, prune_sql = retract_tags_sql(entity, settings)
+
+    def retract(chunk):
+        if journal.active:
+            # Journal only the rows really deleted - a stale row may be implied again, or already gone
+            removed_tags = {}
+            for item_id, tag_id in chunk:
+                if write_cursor.execute(delete_sql, (item_id, tag_id)).rowcount:
+                    removed_tags.setdefault(item_id, []).append(tag_id)
+            journal.record(entity["table"], [(item_id, [], tags) for item_id, tags in removed_tags.items()])
+            removed = sum(map(len, removed_tags.values()))
+        else:
+            write_cursor.executemany(delete_sql, chunk)
+            removed = write_cursor.rowcount
+        write_cursor.executemany(prune_sql, ((entity["table"], item_id, tag_id) for item_id, tag_id in chunk))
+        return removed
+
+    budget = WriteBudget(settings["writeBudgetMs"] / 1000, settings["batchSize"])
+    removed = write_budgeted(write_conn, budget, stale, retract)
+    write_conn.close()
+    metrics.count("rows_written", removed)
+    metrics.entities[entity_key] = {"items": len({item_id for item_id, _ in stale}), "updated": 0,
+                                    "rows": removed, "unchanged": 0}
+    log.info(f"Removed {removed} stale derived {entity['singular']} tags")
+    return removed
+
+
+def run_cleanup(db_path, settings, entity_keys):
+    """Retract stale derived tags for the given entity keys, skipping any disabled in settings"""
+    with metrics.phase("schema_check"):
+        check_schema_version(db_path)
+    with metrics.phase("settings"):
+        exclusion_tag_ids = get_exclusion_tag_ids(db_path, settings)
+    ensure_tag_closure(db_path, settings)
+
+    enabled_keys = [entity_key for entity_key in entity_keys if settings[ENTITY_SETTINGS[entity_key]]]
+    for index, entity_key in enumerate(enabled_keys):
+        cleanup_entity(db_path, settings, exclusion_tag_ids, entity_key)
+        log.progress((index + 1) / len(enabled_keys))
+    log.info("Cleanup complete!")
+
+
+class PlanRecorder:
+    """Cursor and connection stand-in that records the query plan of every statement it is given
+
+    Wraps a read-only connection. Each statement is first run through EXPLAIN QUERY PLAN
+    under the current section. Reads and statements on temp tables then run for real,
+    so the sync functions driven through it get the rows they expect, while writes to
+    the database are only explained. Those report one row changed, so the statements
+    code issues after a successful write are explained too.
+    """
+
+    # Statements that run for real: reads, and writes that only touch temp tables
+    RUN_SQL = r"^\s*(SELECT|WITH|CREATE\s+TEMP|DROP\s+TABLE\s+IF\s+EXISTS\s+temp\.|(INSERT|DELETE)\b[^(]*?\btemp\.)"
+
+    def __init__(self, conn):
+        import re
+        self.run_sql = re.compile(self.RUN_SQL, re.IGNORECASE)
+        self.conn = conn
+        self.real_cursor = conn.cursor()
+        self.statements = {}
+        self.section_name = ""
+        self.whole_table = False
+        self.in_transaction = False
+        self.rowcount = -1
+        self.rows = iter(())
+
+    @contextmanager
+    def section(self, name, whole_table=False):
+        """Record the statements issued inside under name - whole_table marks passes over every row"""
+        self.section_name, self.whole_table = name, whole_table
+        yield self
+
+    def explain(self, sql, params):
+        key = (self.section_name, sql)
+        if key in self.statements:
+            return
+        statement = {"section": self.section_name, "sql": " ".join(sql.split()), "whole_table": self.whole_table}
+        try:
+            self.real_cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+            depths = {0: -1}
+            plan = []
+            for node, parent, _, detail in self.real_cursor.fetchall():
+                depths[node] = depths.get(parent, -1) + 1
+                plan.append("  " * depths[node] + detail)
+            statement["plan"] = plan
+        except sqlite3.Error as e:
+            statement["error"] = str(e)
+        if statement.get("plan") or statement.get("error"):
+            self.statements[key] = statement
+
+    def execute(self, sql, params=()):
+        self.explain(sql, params)
+        self.rows, self.rowcount = iter(()), 1
+        if self.run_sql.match(sql):
+            try:
+                self.rows = self.real_cursor.execute(sql, params)
+                self.rowcount = self.real_cursor.rowcount
+            except sqlite3.OperationalError:
+                # A plugin table that doesn't exist yet - already recorded by explain
+                pass
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        seq_of_params = list(seq_of_params)
+        if seq_of_params:
+            self.explain(sql, seq_of_params[0])
+        self.rows, self.rowcount = iter(()), 0
+        if self.run_sql.match(sql):
+            self.real_cursor.executemany(sql, seq_of_params)
+            self.rowcount = self.real_cursor.rowcount
+        return self
+
+    def fetchone(self):
+        return next(self.rows, None)
+
+    def fetchall(self):
+        return list(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def cursor(self):
+        return self
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+def explain_sync_queries(db_path, settings, exclusion_tag_ids):
+    """Record the plan of every statement the sync, hook and cleanup paths issue
+
+    Drives the real functions through a PlanRecorder, with one representative batch per
+    entity type, so the report always matches the SQL the plugin runs. Ledger statements
+    are included even while provenance tracking is off. Returns the recorded statements.
+    """
+    conn = create_read_connection(db_path)
+    create_temp_plugin_tables(conn.cursor())
+    use_temp_tag_closure(conn.cursor(), settings)
+    recorder = PlanRecorder(conn)
+    parent_tags = settings["includeParentTags"]
+    perf_id = conn.execute("SELECT MIN(performer_id) FROM performers_tags").fetchone()[0] or 0
+
+    with recorder.section("performer tag map", whole_table=True):
+        performer_tags_fingerprint(recorder)
+        tag_relations_fingerprint(recorder)
+        load_performer_tag_pairs(recorder, parent_tags)
+    # The queue is read in seq order from its head and the lease table holds one row
+    with recorder.section("hook queue", whole_table=True):
+        enqueue_item(recorder, "images", 0)
+        acquire_drain_lease(recorder, "explain")
+        drain_pass(recorder, db_path, settings, exclusion_tag_ids, "explain")
+
+    for entity_key, entity in ENTITIES.items():
+        if not settings[ENTITY_SETTINGS[entity_key]]:
+            continue
+        gallery_performers = inherits_gallery_performers(entity, settings["inheritGalleryPerformers"])
+        with recorder.section(f"{entity_key}: filter and count", whole_table=True):
+            where_sql, params = build_filter_sql(recorder, entity, settings, exclusion_tag_ids)
+            count_items(recorder, entity, where_sql, params, gallery_performers)
+        with recorder.section(f"{entity_key}: delta candidates", whole_table=True):
+            load_delta_candidates(recorder, entity, read_watermark(recorder, entity, settings), gallery_performers)
+        with recorder.section(f"{entity_key}: bulk batch"):
+            batch_ids = next(iter_item_batches(recorder, entity, where_sql, params, settings["batchSize"],
+                                               gallery_performers=gallery_performers), [])
+            load_batch(recorder, batch_ids)
+            diff_batch(recorder, entity, batch_ids, {}, settings["tagMode"], gallery_performers)
+            if settings["compactMaps"] and import_numpy() is not None:
+                diff_batch(recorder, entity, batch_ids, PerformerTagMap(array("q")), settings["tagMode"],
+                           gallery_performers)
+            add_tags_sql(recorder, entity, True, parent_tags, gallery_performers)
+            apply_changes(recorder, entity, [(batch_ids[0] if batch_ids else 0, [0], [0])], True, parent_tags,
+                          gallery_performers)
+            save_state(recorder, "explain", {})
+        with recorder.section(f"{entity_key}: hook sync"):
+            sync_batch(recorder, settings, exclusion_tag_ids, entity_key, batch_ids[:10])
+        with recorder.section(f"{entity_key}: performer fan-out"):
+            load_performer_items(recorder, entity, [perf_id], settings["inheritGalleryPerformers"])
+            enqueue_performer_items(recorder, entity_key, perf_id, settings["inheritGalleryPerformers"])
+            if gallery_performers:
+                enqueue_gallery_images(recorder, 0)
+        with recorder.section(f"{entity_key}: stale tag scan", whole_table=True):
+            recorder.execute(stale_tags_sql(entity, settings, where_sql), [entity["table"]] + params)
+        with recorder.section(f"{entity_key}: stale tag retract"):
+            delete_sql, prune_sql = retract_tags_sql(entity, settings)
+            recorder.execute(delete_sql, (0, 0))
+            recorder.execute(prune_sql, (entity["table"], 0, 0))
+
+    conn.close()
+    return list(recorder.statements.values())
+
+
+def plan_findings(statement):
+    """Flag full scans, temp B-trees and automatic indexes in a recorded plan
+
+    Scans of the plugin's temp tables and of materialized subqueries are how batch
+    lookups are meant to run, so only scans of database tables count, and sorts are
+    only flagged in statements that don't start from a batch.
+    """
+    import re
+
+    derived = set()
+    for match in re.finditer(r"\btemp\.(\w+)(?:\s+(\w+))?", statement["sql"]):
+        derived.update(name for name in match.groups() if name)
+    batched = bool(derived)
+    findings = []
+    for line in statement.get("plan", []):
+        detail = line.strip()
+        if detail.startswith(("MATERIALIZE ", "CO-ROUTINE ")):
+            derived.add(detail.split()[1])
+        elif detail.startswith("SCAN ") and detail.split()[1] not in derived | {"CONSTANT"} \
+                and not detail.split()[1].startswith("("):
+            findings.append(f"full scan: {detail}")
+        if "TEMP B-TREE" in detail and not batched:
+            findings.append(f"temp b-tree: {detail}")
+        if "AUTOMATIC" in detail:
+            findings.append(f"automatic index: {detail}")
+    return findings
+
+
+def index_report(cursor, statements):
+    """Columns, size and use of every index on the tables the sync queries touch
+
+    An index is redundant when another index on the same table leads with all of its
+    columns. Sizes come from the dbstat table, where SQLite was built with it.
+    """
+    import re
+
+    used = set()
+    for statement in statements:
+        for line in statement.get("plan", []):
+            used.update(re.findall(r"USING (?:COVERING )?INDEX (\w+)", line))
+
+    tables = [name for entity in ENTITIES.values()
+              for name in (entity["table"], entity["tags_table"], entity["performers_table"])]
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    existing = {row[0] for row in cursor.fetchall()}
+    plugin_indexes = {name for name, _, _ in PLUGIN_INDEXES} | set(RETIRED_PLUGIN_INDEXES)
+
+    report = []
+    for table in tables + QUERY_PLAN_TABLES:
+        if table not in existing:
+            continue
+        indexes = load_index_columns(cursor, table)
+        for name, (columns, unique, partial) in indexes.items():
+            try:
+                cursor.execute("SELECT SUM(pgsize) FROM dbstat WHERE name = ?", (name,))
+                size = cursor.fetchone()[0]
+            except sqlite3.OperationalError:
+                size = None
+            # Of two identical indexes, the unique one or else the first by name is kept
+            redundant_of = None if unique or partial else find_covering_index(
+                {other: value for other, value in indexes.items()
+                 if len(value[0]) > len(columns) or value[1] or other < name},
+                columns, exclude=name)
+            report.append({"table": table, "index": name, "columns": columns, "unique": unique,
+                           "partial": partial, "bytes": size, "used": name in used,
+                           "redundant_of": redundant_of, "plugin": name in plugin_indexes})
+    return report
+
+
+def drop_plugin_indexes(db_path, indexes):
+    """Drop the plugin's own indexes that are redundant or retired - Stash's are never touched"""
+    dropped = [index["index"] for index in indexes
+               if index["plugin"] and (index["redundant_of"] or index["index"] in RETIRED_PLUGIN_INDEXES)]
+    if not dropped:
+        return []
+    conn = create_write_connection(db_path)
+
+    def drop():
+        for name in dropped:
+            conn.execute(f"DROP INDEX IF EXISTS {name}")
+
+    run_write_transaction(conn, drop)
+    conn.close()
+    return dropped
+
+
+def analyze_tables(db_path):
+    """Refresh SQLite's statistics for the tables the sync queries touch
+
+    analysis_limit keeps ANALYZE to a sample of each index, so this stays quick on a
+    large library.
+    """
+    conn = create_write_connection(db_path)
+    cursor = conn.cursor()
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    existing = {row[0] for row in cursor.fetchall()}
+    tables = [name for entity in ENTITIES.values()
+              for name in (entity["table"], entity["tags_table"], entity["performers_table"])]
+    cursor.execute(f"PRAGMA analysis_limit={ANALYSIS_LIMIT}")
+
+    def analyze():
+        for table in tables + QUERY_PLAN_TABLES:
+            if table in existing:
+                cursor.execute(f"ANALYZE {table}")
+
+    run_write_transaction(conn, analyze)
+    conn.close()
+
+
+def create_temp_plugin_tables(cursor):
+    """Temp stand-ins for the plugin's own tables the database doesn't have yet
+
+    Unqualified table names resolve to temp tables first, so statements on a plugin table
+    that hasn't been created can still be explained, without creating it in the database.
+    """
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    existing = {row[0] for row in cursor.fetchall()}
+    tables = {
+        "pts_state": "CREATE TABLE IF NOT EXISTS pts_state (key TEXT PRIMARY KEY, value TEXT NOT NULL)",
+        "pts_queue": QUEUE_TABLE_SQL,
+        "pts_drainer": DRAINER_TABLE_SQL,
+        "pts_provenance": PROVENANCE_TABLE_SQL,
+    }
+    for name, sql in tables.items():
+        if name not in existing:
+            cursor.execute(sql.replace(name, f"temp.{name}", 1))
+
+
+def run_query_plan_check(db_path, settings, optimize=False, drop_indexes=False):
+    """Task entry point: check the sync queries' plans and the indexes they rely on
+
+    Logs every flagged plan outside whole-table passes and every redundant or unused
+    index, and writes the full report next to the database. optimize refreshes table
+    statistics first; drop_indexes drops the plugin's own redundant or retired indexes.
+    """
+    with metrics.phase("schema_check"):
+        check_schema_version(db_path)
+    with metrics.phase("settings"):
+        exclusion_tag_ids = get_exclusion_tag_ids(db_path, settings)
+    if optimize:
+        log.info("Refreshing table statistics (ANALYZE)...")
+        analyze_tables(db_path)
+
+    log.info("Explaining the sync queries...")
+    statements = explain_sync_queries(db_path, settings, exclusion_tag_ids)
+    flagged = 0
+    for statement in statements:
+        statement["findings"] = plan_findings(statement)
+        if statement.get("error"):
+            log.info(f"{statement['section']}: not checked ({statement['error']})")
+        elif statement["findings"] and not statement["whole_table"]:
+            flagged += 1
+            log.warning(f"{statement['section']}: {'; '.join(statement['findings'])} - {statement['sql'][:200]}")
+    log.info(f"Checked {len(statements)} statements, {flagged} with full scans, temp B-trees or automatic "
+             f"indexes outside whole-table passes")
+
+    read_conn = create_read_connection(db_path)
+    indexes = index_report(read_conn.cursor(), statements)
+    read_conn.close()
+    for index in indexes:
+        size = f"{index['bytes'] / 1024:.0f} KB" if index["bytes"] is not None else "size unknown"
+        note = f", redundant with {index['redundant_of']}" if index["redundant_of"] else ""
+        if not index["used"]:
+            note += ", not used by the sync queries"
+        owner = "plugin" if index["plugin"] else "Stash"
+        message = f"Index {index['index']} on {index['table']}({', '.join(index['columns'])}), {owner}: {size}{note}"
+        if index["redundant_of"] and not index["plugin"]:
+            log.info(f"{message} - a candidate to drop, but it belongs to Stash")
+        else:
+            log.info(message)
+
+    dropped = drop_plugin_indexes(db_path, indexes) if drop_indexes else []
+    for name in dropped:
+        log.info(f"Dropped plugin index {name}")
+
+    report = {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "statements": statements, "indexes": indexes,
+              "dropped": dropped}
+    report_path = f"{db_path}.pts-query-plans.json"
+    try:
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+        log.info(f"Query plan report written to {report_path}")
+    except OSError as e:
+        log.warning(f"Could not write query plan report: {e}")
+    log.progress(1.0)
+    return report
+
+
+def run_hook(db_path, settings, hook_context):
+    """Handle a Create/Update hook by syncing only the item that triggered it
+
+    Skips schema checks, index creation and WAL setup - a bulk task has already done
+    those, and the hook needs to return quickly so tagging in the UI stays responsive.
+    """
+    hook_type = hook_context.get("type", "")
+    if hook_type.startswith("Performer."):
+        run_performer_hook(db_path, settings, hook_context)
+        return
+
+    entity_key = HOOK_ENTITIES.get(hook_type.split(".")[0])
+    if entity_key is None:
+        log.debug(f"Ignoring unsupported hook {hook_type}")
+        return
+
+    # With gallery performers inherited, a gallery's performers are also its images'
+    inherit = settings["inheritGalleryPerformers"]
+    gallery_images = inherit and entity_key == "galleries" and settings[ENTITY_SETTINGS["images"]]
+    if not settings[ENTITY_SETTINGS[entity_key]] and not gallery_images:
+        log.debug(f"{hook_type}: {entity_key} sync disabled, skipping")
+        return
+
+    # Updates that didn't touch performers (or, for an inheriting image, its galleries)
+    # can't change the performer tags
+    input_fields = hook_context.get("inputFields")
+    watched_fields = {"performer_ids", "gallery_ids"} if inherit and entity_key == "images" else {"performer_ids"}
+    if ".Update." in hook_type and input_fields is not None and not watched_fields & set(input_fields):
+        log.debug(f"{hook_type}: performers unchanged, skipping")
+        return
+
+    item_id = int(hook_context["id"])
+    exclusion_tag_ids = get_exclusion_tag_ids(db_path, settings)
+    ensure_tag_closure(db_path, settings)
+    if not settings["coalesceHooks"]:
+        if settings[ENTITY_SETTINGS[entity_key]]:
+            stats = sync_item(db_path, settings, exclusion_tag_ids, entity_key, item_id)
+            log.info(f"{hook_type}: synced {ENTITIES[entity_key]['singular']} {item_id} "
+                     f"({stats['rows']} tag rows written)")
+        if gallery_images:
+            conn = create_write_connection(db_path)
+            cursor = conn.execute("SELECT image_id FROM galleries_images WHERE gallery_id = ? ORDER BY image_id",
+                                  (item_id,))
+            image_ids = [row[0] for row in cursor]
+            stats = sync_items(conn, settings, exclusion_tag_ids, "images", image_ids)
+            conn.close()
+            log.info(f"{hook_type}: synced {stats['items']} images of gallery {item_id} "
+                     f"({stats['rows']} tag rows written)")
+        return
+
+    # Queue the item, and drain the queue unless another hook process already is
+    conn = create_write_connection(db_path)
+    owner = f"{os.getpid()}:{time.time()}"
+
+    def enqueue():
+        if settings[ENTITY_SETTINGS[entity_key]]:
+            enqueue_item(conn, entity_key, item_id)
+        if gallery_images:
+            enqueue_gallery_images(conn, item_id)
+        return acquire_drain_lease(conn, owner)
+
+    is_drainer, _ = run_write_transaction(conn, enqueue)
+    if is_drainer:
+        drained = drain_queue(conn, db_path, settings, exclusion_tag_ids, owner)
+        log.info(f"{hook_type}: drained {drained} queued items")
+    else:
+        log.debug(f"{hook_type}: queued {ENTITIES[entity_key]['singular']} {item_id} for the active drainer")
+    conn.close()
+
+
+def run_sync(db_path, settings, entity_keys):
+    """Run a bulk sync for the given entity keys, skipping any disabled in settings"""
+    # Check schema version
+    with metrics.phase("schema_check"):
+        schema_version = check_schema_version(db_path)
+
+    # Create performance indexes
+    with metrics.phase("indexes"):
+        create_indexes_if_needed(db_path)
+
+    # Enable WAL mode for better concurrent access
+    with metrics.phase("wal_mode"):
+        enable_wal_mode(db_path)
+
+    # Get exclusion tag ID if configured
+    with metrics.phase("settings"):
+        exclusion_tag_ids = get_exclusion_tag_ids(db_path, settings)
+
+    # Bring the tag hierarchy closure up to date if parent tags are applied
+    ensure_tag_closure(db_path, settings)
+
+    # Run syncs based on settings
+    enabled_keys = [entity_key for entity_key in entity_keys if settings[ENTITY_SETTINGS[entity_key]]]
+    snapshot = ReadSnapshot(db_path, settings, enabled_keys) if settings["snapshotReads"] else None
+    try:
+        if settings["pipeline"]:
+            sync_pipelined(db_path, settings, exclusion_tag_ids, enabled_keys, snapshot)
+        else:
+            for entity_key in enabled_keys:
+                sync_entity(db_path, settings, exclusion_tag_ids, entity_key, snapshot)
+    finally:
+        if snapshot:
+            snapshot.close()
+
+    log.info("All sync operations complete!")
+    log.progress(1.0)
+
+
+def write_prometheus_textfile(path, report):
+    """Write the run report in the Prometheus text format, for node_exporter's textfile collector"""
+    task = report["task"]
+    lines = [
+        "# HELP performer_tag_sync_last_run_timestamp_seconds Start time of the last run",
+        "# TYPE performer_tag_sync_last_run_timestamp_seconds gauge",
+        f'performer_tag_sync_last_run_timestamp_seconds{{task="{task}"}} {metrics.started:.0f}',
+        "# HELP performer_tag_sync_duration_seconds Wall time of the last run",
+        "# TYPE performer_tag_sync_duration_seconds gauge",
+        f'performer_tag_sync_duration_seconds{{task="{task}"}} {report["duration_seconds"]}',
+        "# HELP performer_tag_sync_phase_seconds Wall time of each phase of the last run",
+        "# TYPE performer_tag_sync_phase_seconds gauge",
+    ]
+    lines += [f'performer_tag_sync_phase_seconds{{task="{task}",phase="{name}"}} {seconds}'
+              for name, seconds in report["phases"].items()]
+    for name, value in report["counters"].items():
+        lines += [
+            f"# HELP performer_tag_sync_{name} {name.replace('_', ' ').capitalize()} in the last run",
+            f"# TYPE performer_tag_sync_{name} gauge",
+            f'performer_tag_sync_{name}{{task="{task}"}} {value}',
+        ]
+    lines += [
+        "# HELP performer_tag_sync_entity_items Items with performers considered in the last run",
+        "# TYPE performer_tag_sync_entity_items gauge",
+    ]
+    lines += [f'performer_tag_sync_entity_items{{task="{task}",entity="{key}"}} {stats["items"]}'
+              for key, stats in report["entities"].items()]
+
+    # Write to a temp file and rename so the collector never reads a partial file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, path)
+
+
+def write_metrics_report(db_path, settings, task):
+    """Emit the run metrics as a JSON log line, append them to the metrics history and
+    write the Prometheus textfile if one is configured"""
+    report = dict(metrics.summary(), task=task, tagMode=settings["tagMode"], engine=settings["engine"])
+    log.info(f"Run metrics: {json.dumps(report, separators=(',', ':'))}")
+    try:
+        with open(f"{db_path}.pts-metrics.ndjson", "a") as f:
+            f.write(json.dumps(report, separators=(",", ":")) + "\n")
+        if settings.get("metricsTextfile"):
+            write_prometheus_textfile(settings["metricsTextfile"], report)
+    except OSError as e:
+        log.warning(f"Could not write run metrics: {e}")
+    return report
+
+
+def main():
+    """Main entry point"""
+    try:
+        args = get_plugin_input().get("args") or {}
+
+        with metrics.phase("settings"):
+            # Load settings
+            settings = load_settings()
+
+            # Get database path
+            db_path = get_database_path()
+
+        if args.get("hookContext"):
+            # Hooks stay on the fast path and don't report run metrics
+            run_hook(db_path, settings, args["hookContext"])
+            return
+
+        task = args.get("mode") or "all"
+        # The journal to roll back is picked before this task's own journal becomes the newest
+        rollback_path = None
+        if task == "rollbackJournal":
+            rollback_path = args.get("journalFile") or latest_journal(db_path)
+        if settings["journalChanges"] and task in JOURNALED_TASKS:
+            start_journal(db_path, settings, task, keep=rollback_path)
+
+        if args.get("mode") == "plan":
+            write_plan(db_path, settings, list(ENTITIES), args.get("planFile") or f"{db_path}.pts-plan.ndjson.gz")
+        elif args.get("mode") == "applyPlan":
+            apply_plan(db_path, settings, args.get("planFile") or f"{db_path}.pts-plan.ndjson.gz")
+        elif args.get("mode") == "cleanupTags":
+            run_cleanup(db_path, settings, list(ENTITIES))
+        elif args.get("mode") == "explainQueries":
+            run_query_plan_check(db_path, settings, bool(args.get("optimize")), bool(args.get("dropIndexes")))
+        elif args.get("mode") == "performers":
+            run_performer_sync(db_path, settings, parse_id_list(args.get("performerIds")))
+        elif args.get("mode") == "rollbackJournal":
+            rollback_journal(db_path, settings, rollback_path)
+        elif args.get("mode") in TASK_ENTITIES:
+            run_sync(db_path, settings, [TASK_ENTITIES[args["mode"]]])
+        else:
+            run_sync(db_path, settings, list(ENTITIES))
+        write_metrics_report(db_path, settings, task)
+
+    except Exception as e:
+        log.error(f"Fatal error: {e}")
+        import traceback
+        log.error(traceback.format_exc())
+        sys.exit(1)
+    finally:
+        journal.close()
+
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Performer Tag Sync multi-library runner
+Syncs several Stash databases in parallel, each in its own worker process with its own
+connections and writer, and prints a summary of items processed, time taken and failures.
+Runs fully offline - no Stash server or stashapi needed - so a single cron job can keep
+every library in sync in about the time of the slowest one.
+
+Each library's settings are the plugin defaults, overlaid with the --settings file if given,
+then with <db>.pts-settings.json next to the database if that exists. Both use the plugin's
+setting names, e.g. {"tagMode": "SET", "excludeTag": "Manual"}.
+
+Usage: python sync_libraries.py [--jobs N] [--settings FILE] [--json summary.json] DATABASE_OR_GLOB...
+"""
+
+import argparse
+import glob
+import importlib.util
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_plugin(label, verbose=False):
+    """Import performer_tag_sync.py, prefixing its log lines with the library label"""
+    spec = importlib.util.spec_from_file_location(
+        "performer_tag_sync", os.path.join(PLUGIN_DIR, "performer_tag_sync.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    class LibraryLog:
+        @staticmethod
+        def info(msg):
+            if verbose:
+                print(f"[{label}] INFO: {msg}", file=sys.stderr)
+        @staticmethod
+        def warning(msg): print(f"[{label}] WARNING: {msg}", file=sys.stderr)
+        @staticmethod
+        def error(msg): print(f"[{label}] ERROR: {msg}", file=sys.stderr)
+        @staticmethod
+        def debug(msg): pass
+        @staticmethod
+        def progress(p): pass
+
+    module.log = LibraryLog
+    return module
+
+
+def resolve_databases(patterns):
+    """Expand database paths and globs, dropping paths that name the same file twice"""
+    databases = {}
+    for pattern in patterns:
+        if any(char in pattern for char in "*?["):
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                print(f"WARNING: {pattern} matches no files", file=sys.stderr)
+        else:
+            matches = [pattern]
+        for path in matches:
+            databases.setdefault(os.path.realpath(path), path)
+    return list(databases.values())
+
+
+def load_library_settings(plugin, db_path, shared_settings):
+    """Settings for one library: defaults, then the shared settings, then <db>.pts-settings.json"""
+    user_settings = dict(shared_settings)
+    settings_path = f"{db_path}.pts-settings.json"
+    if os.path.exists(settings_path):
+        with open(settings_path) as f:
+            user_settings.update(json.load(f))
+    return plugin.merge_settings(user_settings)
+
+
+def sync_library(job):
+    """Worker process: run a full sync of one library and return its summary
+
+    Failures are returned rather than raised, so one broken library doesn't stop the others.
+    """
+    db_path, shared_settings, verbose = job
+    start = time.perf_counter()
+    result = {"database": db_path, "ok": False, "items": 0, "updated": 0, "rows": 0}
+    try:
+        # The write connection would create an empty database for a mistyped path
+        if not os.path.isfile(db_path):
+            raise FileNotFoundError(f"No such database: {db_path}")
+        plugin = load_plugin(db_path, verbose)
+        settings = load_library_settings(plugin, db_path, shared_settings)
+        plugin.metrics.reset()
+        if settings["journalChanges"]:
+            plugin.start_journal(db_path, settings, "all")
+        try:
+            plugin.run_sync(db_path, settings, list(plugin.ENTITIES))
+        finally:
+            plugin.journal.close()
+        report = plugin.write_metrics_report(db_path, settings, "multiLibrary")
+        for stats in report["entities"].values():
+            for key in ("items", "updated", "rows"):
+                result[key] += stats.get(key, 0)
+        result.update(ok=True, tagMode=settings["tagMode"], engine=settings["engine"],
+                      entities=report["entities"], counters=report["counters"])
+    except Exception as e:
+        result.update(error=f"{type(e).__name__}: {e}", traceback=traceback.format_exc())
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def print_result(result):
+    if result["ok"]:
+        print(f"{'ok':6} {result['seconds']:9.2f}s {result['items']:>10} {result['updated']:>10} "
+              f"{result['rows']:>10}   {result['database']}")
+    else:
+        print(f"{'FAILED':6} {result['seconds']:9.2f}s {'':>10} {'':>10} {'':>10}   {result['database']}")
+        print(f"       {result['error']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("databases", nargs="+", help="Database paths or globs, e.g. '/srv/stash-*/stash-go.sqlite'")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1,
+                        help="Libraries to sync at once (default: one per CPU core)")
+    parser.add_argument("--settings", help="JSON file of settings shared by every library")
+    parser.add_argument("--json", help="Write the summary to this file as JSON")
+    parser.add_argument("--verbose", action="store_true", help="Show each library's info log lines")
+    args = parser.parse_args()
+
+    databases = resolve_databases(args.databases)
+    if not databases:
+        parser.error("no databases to sync")
+    shared_settings = {}
+    if args.settings:
+        with open(args.settings) as f:
+            shared_settings = json.load(f)
+    jobs = max(1, min(args.jobs, len(databases)))
+
+    print(f"Syncing {len(databases)} libraries, {jobs} at a time\n")
+    print("Result    Time         Items    Updated  Tag rows   Database")
+    start = time.perf_counter()
+    results = []
+    # A fresh process per library, so no module state carries over from one library to the next
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(jobs, maxtasksperchild=1) as pool:
+        jobs_args = [(db_path, shared_settings, args.verbose) for db_path in databases]
+        for result in pool.imap_unordered(sync_library, jobs_args):
+            print_result(result)
+            results.append(result)
+    elapsed = time.perf_counter() - start
+
+    failed = [result for result in results if not result["ok"]]
+    summary = {
+        "libraries": len(results),
+        "failed": len(failed),
+        "jobs": jobs,
+        "seconds": round(elapsed, 3),
+        "library_seconds": round(sum(result["seconds"] for result in results), 3),
+        "items": sum(result["items"] for result in results),
+        "updated": sum(result["updated"] for result in results),
+        "rows": sum(result["rows"] for result in results),
+        "results": sorted(results, key=lambda result: result["database"]),
+    }
+    print(f"\n{summary['libraries'] - summary['failed']} of {summary['libraries']} libraries synced in "
+          f"{summary['seconds']:.2f}s ({summary['library_seconds']:.2f}s of sync time across libraries): "
+          f"{summary['items']} items, {summary['updated']} updated, {summary['rows']} tag rows")
+    for result in failed:
+        print(f"FAILED {result['database']}\n{result['traceback']}", file=sys.stderr)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+        print(f"Summary written to {args.json}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())